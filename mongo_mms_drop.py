@@ -6,6 +6,11 @@ Created in January 2014
 @author: Daniel Coupal
 
 Script to delete the database of an MMS instance.
+  - by default, it drops all the MMS databases
+  - with '--savebaseline', it saves the config DBs of a clean viewer instance,
+    after its defaults are set, in a local cache
+  - with '--reset', it drops all the MMS databases and restores the saved
+    baseline, so the viewer is ready for the next import
   
 Instructions for using the tools are at:
   https://wiki.mongodb.com/display/cs/MMS+Exporter+and+Importer
@@ -15,6 +20,7 @@ Pre-requisites:
 
 Implementation details:
   - The MMS service should be stopped prior to running this script
+  - The databases are dropped, saved and restored in parallel
 
  TODOs
   - do the stop/start of the MMS instance. The annoyance is that you need root privileges..
@@ -24,16 +30,23 @@ import optparse
 import os
 import pymongo
 import re
+import shutil
 import sys
+import time
 import traceback
 
 ROOTDIR = os.path.dirname(__file__)
 sys.path.insert(0, ROOTDIR)
-import mongommsexport
+import mongo_mms_export
 
 TOOL = "mongommsdrop"
 VERSION = "0.1.0"
 
+BASELINE_DBS = [ mongo_mms_export.DB_CLOUDCONF, mongo_mms_export.DB_MMSCONF ]
+BASELINE_FILE = "baseline"
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".mongo_mms_baseline")
+DEPS = [ "mongodump", "mongorestore" ]
+
 Verbose = False
 
 def get_opts():
@@ -43,8 +56,13 @@ def get_opts():
     parser = optparse.OptionParser(version="%prog " + VERSION)
     group_general = optparse.OptionGroup(parser, "General options")
     parser.add_option_group(group_general)
+    group_general.add_option("--cache", dest="cache", type="string", default=DEFAULT_CACHE, help="directory where the baselines are saved, default %s" % (DEFAULT_CACHE), metavar="DIR")
     group_general.add_option("--host", dest="host", type="string", default='localhost', help="host name of the MMS server", metavar="HOST")
+    group_general.add_option("-j", "--jobs", dest="jobs", type="int", default=mongo_mms_export.DEFAULT_JOBS, help="number of databases to drop, save or restore in parallel", metavar="JOBS")
     group_general.add_option("-p", "--port", dest="port", type="string", default='27017', help="port of the MMS server", metavar="PORT")
+    group_general.add_option("--profile", dest="profile", type="string", default="", help="profile the drop, and write PREFIX%s and PREFIX%s" % (mongo_mms_export.PROFILE_EXT, mongo_mms_export.TRACE_EXT), metavar="PREFIX")
+    group_general.add_option("--reset", dest="reset", action="store_true", default=False, help="drop the MMS databases and restore the baseline saved with '--savebaseline'")
+    group_general.add_option("--savebaseline", dest="savebaseline", action="store_true", default=False, help="save the config DBs of this clean viewer instance as its baseline, nothing is dropped")
     group_general.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="show more output")
     group_security = optparse.OptionGroup(parser, "Security options")
     parser.add_option_group(group_security)
@@ -53,53 +71,139 @@ def get_opts():
     (options, args) = parser.parse_args()
     return options, args
 
-def drop_databases(auth_dict, host, port):
+def drop_databases(auth_dict, host, port, jobs):
+    '''
+    Drop all the MMS databases, in parallel.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param jobs: number of databases to drop at once
+    '''
     if Verbose:
         print "Dropping MMS databases"
     int_port = int(port)
     client = pymongo.mongo_client.MongoClient(host=host, port=int_port)
     if auth_dict is not None:
         client['admin'].authenticate(auth_dict['username'], auth_dict['password'], source=auth_dict['auth_database'])
+    dbs = []
     for one_db in client.database_names():
-        for ok_db in mongommsexport.ALL_MMS_DBS:
+        for ok_db in mongo_mms_export.ALL_MMS_DBS:
             if re.search(ok_db, one_db):
-                client.drop_database(one_db)
+                dbs.append(one_db)
+                break
+    mongo_mms_export.parallel_map(client.drop_database, dbs, jobs)
+
+def get_baseline_dir(cache, host, port):
+    '''
+    Return the directory of the baseline of an MMS instance in the cache.
+    :param cache: directory where the baselines are saved
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    '''
+    return os.path.join(cache, "%s_%s" % (host, port))
+
+def restore_baseline(mongorestore, auth_string, host, port, baseline_dir, jobs):
+    '''
+    Restore the baseline of an MMS instance, one 'mongorestore' per DB.
+    :param mongorestore: path to mongorestore
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param baseline_dir: directory of the baseline in the cache
+    :param jobs: number of databases to restore at once
+    '''
+    baseline_file = open(os.path.join(baseline_dir, BASELINE_FILE), 'r')
+    dbs = baseline_file.read().split()
+    baseline_file.close()
+    print "Restoring the baseline...",
+    def restore_one(one_db):
+        cmd = "%s %s --host %s --port %s --db %s %s" % (mongorestore, auth_string, host, port, one_db, os.path.join(baseline_dir, one_db))
+        mongo_mms_export.run_cmd(cmd, abort=True)
+    mongo_mms_export.parallel_map(restore_one, dbs, jobs)
+    print " done."
+
+def save_baseline(mongodump, auth_string, host, port, baseline_dir, jobs):
+    '''
+    Save the config DBs of a clean MMS viewer instance, after its defaults
+    are set, as the baseline to restore with '--reset'.
+    The previous baseline is replaced only once the new one is complete,
+    the partial one is removed on a failure.
+    :param mongodump: path to mongodump
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param baseline_dir: directory of the baseline in the cache
+    :param jobs: number of databases to save at once
+    '''
+    print "Saving the baseline...",
+    new_dir = "%s.%d" % (baseline_dir, os.getpid())
+    def save_one(one_db):
+        cmd = "%s %s --host %s --port %s --db %s --out %s" % (mongodump, auth_string, host, port, one_db, new_dir)
+        mongo_mms_export.run_cmd(cmd, abort=True)
+    os.makedirs(new_dir)
+    try:
+        mongo_mms_export.parallel_map(save_one, BASELINE_DBS, jobs)
+        baseline_file = open(os.path.join(new_dir, BASELINE_FILE), 'w')
+        baseline_file.write("\n".join(BASELINE_DBS) + "\n")
+        baseline_file.close()
+        if os.path.exists(baseline_dir):
+            shutil.rmtree(baseline_dir)
+        os.rename(new_dir, baseline_dir)
+    finally:
+        # Don't leave a partial baseline behind on a failure
+        if os.path.exists(new_dir):
+            shutil.rmtree(new_dir)
+    print " done."
 
-    
 def main():
     '''
     The main module.
     '''
     global Verbose
-    sys.stdout = mongommsexport.flushfile(sys.stdout)
+    sys.stdout = mongo_mms_export.flushfile(sys.stdout)
     (options, args) = get_opts()
     if args:
-        mongommsexport.fatal("Found trailing arguments: %s" % (str(args)))
+        mongo_mms_export.fatal("Found trailing arguments: %s" % (str(args)))
     if options.verbose:
         Verbose = True
-        mongommsexport.Verbose = True
+        mongo_mms_export.Verbose = True
         print "Verbose mode on, will show more info..."
         print "%s version %s" % (TOOL, VERSION)
         print "Running Python version %s" % (sys.version)
+    if options.profile:
+        mongo_mms_export.start_profiling(options.profile)
     auth_string = ''
     auth_dict = None
     if options.username or options.password:
         if not options.username or not options.password:
-            mongommsexport.fatal("You must provide both: --username and --password")
+            mongo_mms_export.fatal("You must provide both: --username and --password")
         else:
-            auth_string = "--username %s --password %s --authenticationDatabase %s" % (options.username, options.password, mongommsexport.AUTH_DB)
+            auth_string = "--username %s --password %s --authenticationDatabase %s" % (options.username, options.password, mongo_mms_export.AUTH_DB)
             auth_dict = dict()
             auth_dict['username'] = options.username
             auth_dict['password'] = options.password
-            auth_dict['auth_database'] = mongommsexport.AUTH_DB
+            auth_dict['auth_database'] = mongo_mms_export.AUTH_DB
+    if options.reset and options.savebaseline:
+        mongo_mms_export.fatal("Use either '--reset' or '--savebaseline'")
     try:
-        options.host = mongommsexport.get_host(options.host)
-        drop_databases(auth_dict, options.host, options.port) 
+        options.host = mongo_mms_export.get_host(options.host)
+        baseline_dir = get_baseline_dir(options.cache, options.host, options.port)
+        start = time.time()
+        if options.savebaseline:
+            paths = mongo_mms_export.find_paths(DEPS)
+            save_baseline(paths['mongodump'], auth_string, options.host, options.port, baseline_dir, options.jobs)
+        elif options.reset:
+            paths = mongo_mms_export.find_paths(DEPS)
+            # Check before dropping anything
+            if not os.path.isfile(os.path.join(baseline_dir, BASELINE_FILE)):
+                mongo_mms_export.fatal("No baseline saved for this MMS instance in %s, run with '--savebaseline' on a clean viewer first" % (baseline_dir))
+            drop_databases(auth_dict, options.host, options.port, options.jobs)
+            restore_baseline(paths['mongorestore'], auth_string, options.host, options.port, baseline_dir, options.jobs)
+            print "Viewer reset in %ds" % (time.time() - start)
+        else:
+            drop_databases(auth_dict, options.host, options.port, options.jobs)
     except Exception, e:
-        mongommsexport.error("caught exception:\n  " + e.__str__())
+        mongo_mms_export.error("caught exception:\n  " + e.__str__())
         if Verbose:
             traceback.print_exc()
-    if mongommsexport.Errors:
+    if mongo_mms_export.Errors:
         print "The script terminated with errors"
     
          
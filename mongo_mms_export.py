@@ -9,7 +9,11 @@ Script to export an MMS instance.
   - it connects to the MMS host
   - calculates the size of the data to dump and ensure we have enough space
   - dump all data with 'mongodump' and 'mongoexport'
+    - with '--dbpath', on the database host, the data files are copied instead
+    - with '--spool', the databases are spread over several directories/disks
+    - with '--shards', the shards of a sharded backing store are dumped at once
   - parse the data to remove some potential sensitive data
+  - optionally encode the metrics by columns, which compresses much better
   - tar the resulting file
   - scp the resulting file in the MongoDB dropbox
 
@@ -30,33 +34,68 @@ Implementation details:
   - support Kerberos
 '''
     
-import commands
-import fileinput
+import atexit
+import fnmatch
 import glob
+import itertools
+import multiprocessing
+import operator
 import optparse
 import os
 import re
 import shutil
+import signal
 import socket
+import struct
+import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import traceback
+import zlib
+
+try:
+    from hashlib import sha1 as new_checksum
+except ImportError:
+    from sha import new as new_checksum
 
 TOOL = "mongo_mms_export"
 VERSION = "0.1.0"
 
+ARCHIVE_EXT = ".mmsa"
+ARCHIVE_FORMATS = ("gzip", "indexed")
+ARCHIVE_MAGIC = "MMSARCH1"
+ARCHIVE_TRAILER = "MMSINDEX"
 AUTH_DB = "admin"
 COLLECTIONS_DIR = "_collections"
 DB_CLOUDCONF = "cloudconf"
 DB_MMSCONF = "mmsdbconfig"
+COPY_BUFSIZE = 16 * 1024 * 1024
+DEFAULT_JOBS = 4
 DEPS = ("mongo", "mongodump", "mongoexport")
 DUMPDIR = "dump"
 FTP_PREFIX = "MMS-"
 IMPORTER_LOGS = ("importer", "logs")
+IO_BUFSIZE = 1024 * 1024
+LOCAL_MONGOD_LOG = "mongod_local.log"
+LOCALHOST = "127.0.0.1"
+MANIFEST_FILE = "manifest"
+MAX_BACKOFF = 60
 MIN_DISK_SPACE = 3000
 MMS_VERSION_FILE = "mms_version"
 NUL_DOMAIN = "example.com"
+PHYSICAL_DIR = "dbpath"
+PHYSICAL_EXCLUDE = ("diagnostic.data", "mongod.lock")
+PHYSICAL_LOCAL_DB = "local"
+PHYSICAL_TEMP = ("diagnostic.data", "journal", "mongod.lock")
+PROBE_INTERVAL = 5
+PROBE_TIMEOUT = 5
+READ_PREFERENCES = ("primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest")
+SHARDS_DIR = "dump_shards"
+SHARD_QUERIES_DIR = "queries"
+THROTTLE_INTERVAL = 1
 
 FILES_TO_REMOVE = [
                    "cloudconf/app.migrations.bson",
@@ -73,12 +112,93 @@ MAX_UNEXPECTED_DBS = 0
 MIN_EXPECTED_DBS = 14
 ALL_MMS_DBS = [ r"^apiv3$", r"^alerts$", r"^cloudconf$", r"^importer", r"^mmsdb.*", r"^mongo-distributed-lock$" ]
 IGNORE_DBS = [ r"^admin", r"^config$", r"^local$", r"^test$" ]
+METRICS_DBS = [ r"^mmsdbrrd", r"^mmsdbpings", r"^mmsdbprofile" ]
 
 # OS - specific?
 HOSTS_FILE = "/etc/hosts"
 
+# Deduplicating store, see 'store_dump'
+CHUNK_AVG = 1024 * 1024
+CHUNK_MAX = 8 * 1024 * 1024
+CHUNK_MIN = 256 * 1024
+PACK_EXT = ".mmsd"
+STORE_CHUNKS = "chunks"
+STORE_RECIPES = "recipes"
+
+# Script printing the chunk ranges owned by each shard, see 'get_shard_queries'.
+# The adjacent chunks on the same shard are merged, then each range becomes
+# a query on the shard key, compared field by field like the chunks are. The
+# query operators only compare values of the same type, so the shard key
+# values of a collection must all have the same type, as they do in MMS.
+SHARD_QUERIES_JS = """
+var isBound = function(value, bound) { return bsonWoCompare({ v: value }, { v: bound }) == 0; };
+var above = function(fields, min, i) {
+    if (i == fields.length || isBound(min[fields[i]], MinKey)) {
+        return [ {} ];
+    }
+    var gt = {};
+    gt[fields[i]] = { $gt: min[fields[i]] };
+    var res = [ gt ];
+    above(fields, min, i + 1).forEach(function(q) { q[fields[i]] = min[fields[i]]; res.push(q); });
+    return res;
+};
+var below = function(fields, max, i) {
+    if (i == fields.length) {
+        return [];
+    }
+    if (isBound(max[fields[i]], MaxKey)) {
+        return [ {} ];
+    }
+    var lt = {};
+    lt[fields[i]] = { $lt: max[fields[i]] };
+    var res = [ lt ];
+    below(fields, max, i + 1).forEach(function(q) { q[fields[i]] = max[fields[i]]; res.push(q); });
+    return res;
+};
+db.getSiblingDB("config").collections.find({ dropped: { $ne: true } }).forEach(function(coll) {
+    var fields = Object.keys(coll.key);
+    var hashed = fields.some(function(f) { return coll.key[f] == "hashed"; });
+    print(coll._id + "\t\t" + (hashed ? "hashed" : ""));
+    if (hashed) {
+        return;
+    }
+    var ranges = {};
+    var last = null;
+    db.getSiblingDB("config").chunks.find({ ns: coll._id }).sort({ min: 1 }).forEach(function(chunk) {
+        if (last && last.shard == chunk.shard) {
+            last.max = chunk.max;
+            return;
+        }
+        last = { shard: chunk.shard, min: chunk.min, max: chunk.max };
+        (ranges[chunk.shard] = ranges[chunk.shard] || []).push(last);
+    });
+    for (var shard in ranges) {
+        var query = { $or: ranges[shard].map(function(r) {
+            return { $and: [ { $or: above(fields, r.min, 0) }, { $or: below(fields, r.max, 0) } ] };
+        }) };
+        print(coll._id + "\t" + shard + "\t" + tojson(query, "", true));
+    }
+});
+"""
+
+# Columnar encoding of the metrics, see 'encode_timeseries'
+BSON_FIXED_SIZES = { 0x01:8, 0x06:0, 0x07:12, 0x08:1, 0x09:8, 0x0A:0, 0x10:4, 0x11:8, 0x12:8, 0x13:16, 0x7F:0, 0xFF:0 }
+INT32 = struct.Struct("<i")
+INT64_MASK = 0xFFFFFFFFFFFFFFFF
+TIMESERIES_BLOCK = 4 * 1024 * 1024
+TIMESERIES_EXT = ".bsonts"
+TIMESERIES_MAGIC = "MMSTS001"
+
+# Profiling
+BLOCK_SIZE = 512
+PROFILE_EXT = ".pstats"
+TRACE_EXT = ".trace.json"
+
 Errors = 0
 Norun = False
+Trace = None
+TraceLock = threading.Lock()
+TraceThreads = { "MainThread":0 }
 Verbose = False
 
 def get_opts():
@@ -89,11 +209,23 @@ def get_opts():
     group_general = optparse.OptionGroup(parser, "General options")
     parser.add_option_group(group_general)
     group_general.add_option("-c", "--caseid", dest="caseid", type="string", default="", help="caseid/ticket to associate the data with, for example 12345 for the case ID ec-12345", metavar="CASEID")    
+    group_general.add_option("--compact", dest="compact", action="store_true", default=False, help="with '--zip' or '--ship', encode the collections of the metrics DBs by columns, which makes them about half to three quarters of their gzip size. The encoding and the decoding on import are in Python, run by '--jobs' processes, and slower than gzip alone")
+    group_general.add_option("--dbpath", dest="dbpath", type="string", default="", help="when running on the MMS database host, copy the data files of its 'mongod' from DIR instead of dumping the documents. Needs 'mongod' in the path", metavar="DIR")
     group_general.add_option("-d", "--directory", dest="directory", type="string", default=".", help="directory where to put the tar file", metavar="DIR")
+    group_general.add_option("--format", dest="format", type="choice", choices=ARCHIVE_FORMATS, default="gzip", help="archive format for '--zip' and '--ship': 'gzip' (tar.gz) or 'indexed' (per collection compression with a table of contents)", metavar="FORMAT")
     group_general.add_option("-f", "--force", dest="force", action="store_true", default=False, help="force removal of a previous 'dump' directory")
     group_general.add_option("--host", dest="host", type="string", default='localhost', help="host name of the MMS server", metavar="HOST")
+    group_general.add_option("-i", "--inventory", dest="inventory", type="string", default="", help="export all the MMS servers listed in FILE, one per line as: HOST PORT CASEID [USERNAME PASSWORD]", metavar="FILE")
+    group_general.add_option("-j", "--jobs", dest="jobs", type="int", default=DEFAULT_JOBS, help="number of files to checksum, or processes encoding the metrics with '--compact', in parallel", metavar="JOBS")
     group_general.add_option("-p", "--port", dest="port", type="string", default='27017', help="port of the MMS server", metavar="PORT")
+    group_general.add_option("--profile", dest="profile", type="string", default="", help="profile the export, and write PREFIX%s and PREFIX%s" % (PROFILE_EXT, TRACE_EXT), metavar="PREFIX")
+    group_general.add_option("--shards", dest="shards", action="store_true", default=False, help="the MMS backing store is sharded, dump its shards directly instead of going through the 'mongos' given with '--host'. Each shard only dumps the chunks it owns, '--readers' and '--maxlatency' apply to each shard, and '--maxrate' is shared by the shards. Needs the users on the shards and 'mongodump' 3.2 or later, and reads from secondaries unless '--readpref' is given")
+    group_general.add_option("--shardjobs", dest="shardjobs", type="int", default=0, help="with '--shards', number of shards to dump at once, all by default", metavar="SHARDS")
+    group_general.add_option("--snapshot", dest="snapshot", action="store_true", default=False, help="the '--dbpath' files are a filesystem snapshot or belong to a stopped server, so the server is not locked while they are copied")
+    group_general.add_option("--spool", dest="spool", action="append", default=[], help="another directory, usually on another disk, to spread the dump over. The databases are placed in '--directory' and the spool dirs by free space and measured throughput, within the '--readers' databases dumped at once. Use at least as many readers as dirs to write to all of them at once. Can be repeated", metavar="DIR")
+    group_general.add_option("--store", dest="store", type="string", default="", help="also add the dump to the deduplicating store in DIR. With '--zip' or '--ship', only the data not already in the store is packaged", metavar="DIR")
     group_general.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="show more output")
+    group_general.add_option("-w", "--workers", dest="workers", type="int", default=DEFAULT_JOBS, help="number of MMS servers from '--inventory' to export at once", metavar="WORKERS")
     group_security = optparse.OptionGroup(parser, "Security options")
     parser.add_option_group(group_security)
     group_security.add_option("--nocheck", dest="nocheck", action="store_true", default=False, help="don't run any check, you must ensure you have enough space, ...")
@@ -102,9 +234,65 @@ def get_opts():
     group_security.add_option("-s", "--ship", dest="ship", action="store_true", default=False, help="ship the data under the given '-caseid' number")
     group_security.add_option("--username", dest="username", type="string", default='', help="username for a secured MMS DB", metavar="USERNAME")
     group_security.add_option("-z", "--zip", dest="zip", action="store_true", default=False, help="zip the data, but do not ship it")
+    group_throttle = optparse.OptionGroup(parser, "Throttling options, to limit the impact on a production MMS database")
+    parser.add_option_group(group_throttle)
+    group_throttle.add_option("--maxlatency", dest="maxlatency", type="int", default=0, help="pause the dump, for longer and longer periods, while the server answers a probe in more than MS milliseconds", metavar="MS")
+    group_throttle.add_option("--maxrate", dest="maxrate", type="float", default=0, help="maximum dump rate in MB per second", metavar="MB")
+    group_throttle.add_option("--readers", dest="readers", type="int", default=1, help="number of databases to dump at once", metavar="READERS")
+    group_throttle.add_option("--readpref", dest="readpref", type="string", default="", help="read preference of 'mongodump', for example 'secondary' to not read from the primary. Needs 'mongodump' 3.2 or later", metavar="MODE")
     (options, args) = parser.parse_args()
     return options, args
 
+def clean_data_files(paths, directory, caseid):
+    '''
+    Remove the sensitive information from data files copied by
+    'export_data_files', like 'clean_dumped_data' does for a dump.
+    A 'mongod' is started on the copy, to export the additional data from
+    the same point in time, and to drop the namespaces of FILES_TO_REMOVE.
+    With MMAPv1, a dropped collection stays in the data files until the
+    database is repaired, so the databases are repaired after the drops.
+    The "local" DB, with the oplog, is dropped too.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param directory: directory where the "dump" dir is located.
+    :param caseid: case ID to associate the data with.
+    '''
+    dump_dir = os.path.join(directory, DUMPDIR)
+    data_dir = os.path.join(dump_dir, PHYSICAL_DIR)
+    port = start_local_mongod(paths['mongod'], data_dir, os.path.join(directory, LOCAL_MONGOD_LOG))
+    try:
+        export_additional_data(paths['mongoexport'], "", LOCALHOST, port, dump_dir, caseid)
+        print "Removing sensitive information like user, emails, ..."
+        cmd = "(db.serverStatus().storageEngine || {name:'mmapv1'}).name"
+        (_, out) = run_mongoshell_cmd(paths['mongo'], "", LOCALHOST, port, "admin", cmd, norun=Norun)
+        mmapv1 = out and out[0].strip() == '"mmapv1"'
+        dbs = list_mms_dbs(paths['mongo'], "", LOCALHOST, port)
+        dbs_to_repair = []
+        for one_glob in FILES_TO_REMOVE:
+            (db_glob, file_glob) = one_glob.split("/")
+            for one_db in fnmatch.filter(dbs, db_glob):
+                if file_glob == "*":
+                    cmd = "db.dropDatabase().ok"
+                else:
+                    cmd = "db.getCollection('%s').drop()" % (file_glob[:-len(".bson")])
+                    if mmapv1 and one_db not in dbs_to_repair:
+                        dbs_to_repair.append(one_db)
+                run_mongoshell_cmd(paths['mongo'], "", LOCALHOST, port, one_db, cmd, norun=Norun)
+        for one_db in dbs_to_repair:
+            run_mongoshell_cmd(paths['mongo'], "", LOCALHOST, port, one_db, "db.repairDatabase().ok", norun=Norun)
+        # The oplog holds the writes to the collections dropped above, and
+        # 'mongodump' never exports it
+        run_mongoshell_cmd(paths['mongo'], "", LOCALHOST, port, PHYSICAL_LOCAL_DB, "db.dropDatabase().ok", norun=Norun)
+    finally:
+        stop_local_mongod(paths['mongod'], data_dir)
+    # Files of the 'mongod' we just ran, and its journal, not needed after
+    # a clean shutdown
+    for name in PHYSICAL_TEMP:
+        path = os.path.join(data_dir, name)
+        if os.path.isdir(path):
+            safe_rm_tree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
 def clean_dumped_data(directory):
     '''
     Remove some directories and files from the "dump" directory.
@@ -122,6 +310,60 @@ def clean_dumped_data(directory):
                     fatal("That does not look like MMS database, missing collection: %s" % (file_to_rm))
                 os.remove(file_to_rm)
 
+def compile_timeseries_shape(shape):
+    '''
+    Return the regular expression matching the elements of the documents
+    of a shape, with a group for each value, and the indexes of the string
+    values, or (None, ()) if the shape has values of variable size other
+    than strings.
+    A string is matched up to its first NUL byte, so its size must be
+    checked against its length.
+    :param shape: sequence of the (type, key) of the elements
+    '''
+    pattern = []
+    string_fields = []
+    for (i, (value_type, key)) in enumerate(shape):
+        if value_type == 0x02:
+            value = "(.{4}[^\x00]*\x00)"
+            string_fields.append(i)
+        elif value_type in BSON_FIXED_SIZES:
+            value = "(.{%d})" % (BSON_FIXED_SIZES[value_type])
+        else:
+            return (None, ())
+        pattern.append(re.escape(chr(value_type) + key + "\x00") + value)
+    return (re.compile("".join(pattern), re.DOTALL), tuple(string_fields))
+
+def copy_data_files(dbpath, target, jobs):
+    '''
+    Copy the data files of a 'mongod', with large sequential reads and
+    writes, several files at a time. The lock file and the diagnostic
+    data, PHYSICAL_EXCLUDE, are left out.
+    :param dbpath: data directory of the 'mongod'
+    :param target: directory to copy the files to
+    :param jobs: number of files to copy in parallel
+    '''
+    files = []
+    prefix = os.path.join(dbpath, "")
+    for (root, dirs, names) in os.walk(dbpath):
+        for name in PHYSICAL_EXCLUDE:
+            if name in dirs:
+                dirs.remove(name)
+        rel_root = root[len(prefix):]
+        if not os.path.isdir(os.path.join(target, rel_root)):
+            os.makedirs(os.path.join(target, rel_root))
+        for name in names:
+            if name not in PHYSICAL_EXCLUDE:
+                files.append(os.path.join(rel_root, name))
+    def copy_one(name):
+        source_file = open(os.path.join(dbpath, name), 'rb')
+        target_file = open(os.path.join(target, name), 'wb')
+        shutil.copyfileobj(source_file, target_file, COPY_BUFSIZE)
+        target_file.close()
+        source_file.close()
+    parallel_map(copy_one, files, jobs)
+    if Verbose:
+        print "  copied %d files" % (len(files))
+
 def doc_to_json(doc):
     '''
     Return a JSON string from a document.
@@ -138,21 +380,404 @@ def doc_to_json(doc):
     doc_str += ' }'
     return doc_str
 
-def dump_database(mongodump, auth_string, host, port, directory):
+def dump_database(mongodump, auth_string, host, port, directory, read_pref=""):
     '''
     Dump the database with "mongodump".
     :param mongodump: path to the executable mongodump.
     :param host: host where the source MMS instance is. Default to localhost.
     :param port: port to access the database. Default to 27017.
     :param directory: directory where to dump to database.
+    :param read_pref: optional read preference for "mongodump".
     '''
     print "Dumping database...",
     cmd = "%s %s --host %s --port %s" % (mongodump, auth_string, host, port)
+    if read_pref:
+        cmd += " --readPreference %s" % (read_pref)
     if directory != ".":
         cmd = "cd %s && %s" % (directory, cmd)
     run_cmd(cmd, abort=True, norun=Norun)
     print "  done."
     
+def dump_database_throttled(mongodump, auth_string, host, port, directory, dbs, readers, max_rate, max_latency, read_pref="", spools=None, collections=None):
+    '''
+    Dump the databases with "mongodump", one process per database, while
+    limiting the load on a production MMS database:
+      - at most 'readers' processes run at once
+      - the processes are paused with SIGSTOP while the data written in the
+        dump directory goes over 'max_rate' MB/s
+      - the processes are paused, for longer and longer periods, while a
+        cheap probe of the server takes more than 'max_latency' ms
+    With spool dirs, each database is dumped in the one picked by
+    'pick_spool', and linked in the "dump" dir with 'link_spool'.
+    The collections given apart are left out of the dump of their database,
+    and dumped alone with their query file, if any.
+    :param mongodump: path to the executable mongodump.
+    :param host: host where the source MMS instance is, or a replica set
+                 as 'replset/host1:port1,host2:port2'.
+    :param port: port to access the database, empty for a replica set.
+    :param directory: directory where to dump to database.
+    :param dbs: list of the databases to dump.
+    :param readers: number of databases to dump at once.
+    :param max_rate: maximum rate in MB/s, 0 for no limit.
+    :param max_latency: latency in ms over which we back off, 0 to not probe.
+    :param read_pref: optional read preference for "mongodump".
+    :param spools: optional list of the dirs to spread the databases over,
+                   including 'directory'.
+    :param collections: optional dict of the collections to dump apart, by
+                        database, as lists of (collection, query file), the
+                        collection is not dumped if the query file is None.
+    '''
+    print "Dumping databases, %d at a time..." % (readers)
+    dump_dir = os.path.join(directory, DUMPDIR)
+    if not spools:
+        spools = [ directory ]
+    spool_stats = dict([ (spool, (0, 0)) for spool in spools ])
+    db_spools = {}
+    pending = []
+    for one_db in dbs:
+        db_args = []
+        coll_jobs = []
+        for (coll, query_file) in (collections or {}).get(one_db, []):
+            db_args.extend([ "--excludeCollection", coll ])
+            if query_file:
+                coll_jobs.append((one_db, [ "--collection", coll, "--queryFile", query_file ]))
+        pending.append((one_db, db_args))
+        pending.extend(coll_jobs)
+    running = []
+    window_start = time.time()
+    window_size = get_dir_size(dump_dir)
+    last_probe = 0
+    backoff = 0
+    (probe_host, probe_port) = (host, port)
+    if not port:
+        (probe_host, probe_port) = get_seed(host)
+    while pending or running:
+        while pending and len(running) < readers:
+            (one_db, args) = pending.pop(0)
+            cmd = [ mongodump ] + auth_string.split() + [ "--host", host, "--db", one_db ] + args
+            if port:
+                cmd.extend([ "--port", port ])
+            if read_pref:
+                cmd.extend([ "--readPreference", read_pref ])
+            if Norun:
+                print "Would run CMD: ", " ".join(cmd)
+                continue
+            spool = db_spools.get(one_db)
+            if spool is None:
+                spool = pick_spool(spools, [ one_running[5] for one_running in running ], spool_stats)
+                db_spools[one_db] = spool
+                if spool != directory:
+                    link_spool(dump_dir, os.path.join(spool, DUMPDIR), one_db)
+            if Verbose:
+                print "Running CMD: %s, in %s" % (" ".join(cmd), spool)
+            out = tempfile.TemporaryFile()
+            running.append((one_db, subprocess.Popen(cmd, cwd=spool, stdout=out, stderr=subprocess.STDOUT), out, time.time(), " ".join(cmd), spool))
+        if not running:
+            continue
+        time.sleep(THROTTLE_INTERVAL)
+        for one_running in running[:]:
+            (one_db, process, out, start, cmd_string, spool) = one_running
+            result = reap_process(process, block=False)
+            if result is None:
+                continue
+            trace_cmd(cmd_string, start, process.returncode, result[1], out.tell())
+            running.remove(one_running)
+            if process.returncode != 0:
+                for other_running in running:
+                    os.kill(other_running[1].pid, signal.SIGTERM)
+                out.seek(0)
+                raise Exception("ERROR in running - %s\n%s" % (cmd_string, out.read()))
+            out.close()
+            (spool_size, spool_time) = spool_stats[spool]
+            spool_stats[spool] = (spool_size + get_dir_size(os.path.join(spool, DUMPDIR, one_db)), spool_time + time.time() - start)
+            if Verbose:
+                print "  dumped %s" % (one_db)
+        pause = 0
+        now = time.time()
+        if max_rate:
+            size = get_dir_size(dump_dir)
+            over = (size - window_size) / (1024.0 * 1024.0) - max_rate * (now - window_start)
+            if over > 0:
+                pause = over / max_rate
+        if max_latency and now - last_probe >= PROBE_INTERVAL:
+            latency = probe_latency(probe_host, probe_port)
+            last_probe = now
+            if latency is None or latency > max_latency:
+                backoff = min(max(backoff * 2, PROBE_INTERVAL), MAX_BACKOFF)
+                if Verbose:
+                    print "  server latency over %d ms, pausing for %d s" % (max_latency, backoff)
+                pause = max(pause, backoff)
+            else:
+                backoff = 0
+        if pause and running:
+            pause_processes([ one_running[1] for one_running in running ], pause)
+        elif pause:
+            # Over the budget with nothing left running, wait before starting the next readers
+            time.sleep(pause)
+        window_start = time.time()
+        window_size = get_dir_size(dump_dir)
+    print "  done."
+
+def dump_shards(paths, auth_string, host, port, directory, shards, options):
+    '''
+    Dump the MMS databases of a sharded MMS backing store, one shard per
+    thread, so the dump is not limited to a single 'mongos'.
+    Each shard is dumped with 'dump_database_throttled' in its own dir,
+    from a secondary when the shard is a replica set, then the dumps are
+    merged into the "dump" dir with 'merge_shard_dumps'.
+    A shard may hold orphaned documents of the chunks moved to another
+    shard, so each sharded collection is dumped with a query on the chunk
+    ranges the shard owns, see 'get_shard_queries'.
+    Each shard is its own server, so 'readers' and 'maxlatency' apply to
+    each shard, while 'maxrate' is shared by the shards dumped at once.
+    The balancer should be stopped during the export, or the chunks moved
+    meanwhile may be missing, or found twice, in the dump.
+    The users must exist on the shards themselves, as we don't go through
+    the 'mongos'.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param host: host of the 'mongos'.
+    :param port: port of the 'mongos'.
+    :param directory: directory where to put the "dump" dir.
+    :param shards: list of (name, host) of the shards, from 'get_shards'.
+    :param options: command line options, for the throttling.
+    '''
+    shard_jobs = len(shards)
+    if options.shardjobs:
+        shard_jobs = min(shard_jobs, options.shardjobs)
+    shard_rate = options.maxrate / shard_jobs
+    print "Dumping %d shards, %d at a time..." % (len(shards), shard_jobs)
+    shards_dir = os.path.join(directory, SHARDS_DIR)
+    if os.path.exists(shards_dir):
+        if options.force:
+            safe_rm_tree(shards_dir)
+        else:
+            fatal("You must use '--force' OR remove manually the directory: %s" % (shards_dir))
+    os.makedirs(shards_dir)
+    (sharded, queries) = get_shard_queries(paths['mongo'], auth_string, host, port, shards_dir)
+    def dump_one(shard):
+        (name, shard_host) = shard
+        (seed_host, seed_port) = get_seed(shard_host)
+        shard_dir = os.path.join(shards_dir, name)
+        queries_dir = os.path.join(shard_dir, SHARD_QUERIES_DIR)
+        os.makedirs(queries_dir)
+        dbs = list_mms_dbs(paths['mongo'], auth_string, seed_host, seed_port)
+        collections = {}
+        for namespace in sharded:
+            (one_db, coll) = namespace.split(".", 1)
+            if one_db not in dbs:
+                continue
+            query_file = None
+            if (namespace, name) in queries:
+                query_file = os.path.join(queries_dir, namespace + ".json")
+                out = open(query_file, 'w')
+                out.write(queries[(namespace, name)])
+                out.close()
+            collections.setdefault(one_db, []).append((coll, query_file))
+        if "/" in shard_host:
+            # Replica set, let 'mongodump' pick a member
+            dump_database_throttled(paths['mongodump'], auth_string, shard_host, "", shard_dir, dbs, options.readers, shard_rate, options.maxlatency, options.readpref or "secondaryPreferred", collections=collections)
+        else:
+            dump_database_throttled(paths['mongodump'], auth_string, seed_host, seed_port, shard_dir, dbs, options.readers, shard_rate, options.maxlatency, options.readpref, collections=collections)
+        return shard_dir
+    shard_dirs = parallel_map(dump_one, shards, shard_jobs)
+    if not Norun:
+        merge_shard_dumps(shard_dirs, directory)
+    safe_rm_tree(shards_dir)
+    print "  done."
+
+def encode_timeseries(bson_path, target, pool=None, jobs=1):
+    '''
+    Encode a dumped collection of samples by columns, in blocks of about
+    TIMESERIES_BLOCK bytes, each compressed with zlib.
+    The samples have the same few keys, increasing dates and slowly changing
+    values, so the columns compress much better than the documents with gzip.
+    The decoding rebuilds the exact same BSON, see 'decode_timeseries'.
+    :param bson_path: dumped ".bson" file to encode
+    :param target: file to write the encoded collection to
+    :param pool: optional process pool encoding the blocks
+    :param jobs: number of processes in the pool
+    '''
+    def iter_blocks():
+        docs = []
+        size = 0
+        for doc in iter_bson_docs(bson_path):
+            docs.append(doc)
+            size += len(doc)
+            if size >= TIMESERIES_BLOCK:
+                yield docs
+                docs = []
+                size = 0
+        if docs:
+            yield docs
+    out = open(target, 'wb')
+    out.write(TIMESERIES_MAGIC)
+    try:
+        for data in map_timeseries_blocks(pack_timeseries_block, iter_blocks(), pool, jobs):
+            out.write(data)
+    finally:
+        out.close()
+
+def encode_timeseries_block(docs):
+    '''
+    Encode a block of documents by columns, one per top level key and type:
+      - the shapes, the sequences of (type, key), each document refers to
+      - the shape of each document
+      - the values of each column, see 'encode_timeseries_column'
+    The documents are split with the regular expression of the shape of the
+    previous document, see 'compile_timeseries_shape', and only parsed with
+    'iter_bson_elements' when the shape changes.
+    :param docs: list of BSON documents
+    '''
+    shapes = {}
+    shape_list = []
+    shape_ids = []
+    patterns = []
+    rows = []
+    (pattern, string_fields) = (None, ())
+    shape_id = None
+    for doc in docs:
+        values = None
+        if pattern is not None:
+            match = pattern.match(doc, 4)
+            if match is not None and match.end() == len(doc) - 1 and doc[-1] == "\x00":
+                values = match.groups()
+                for i in string_fields:
+                    if INT32.unpack(values[i][:4])[0] != len(values[i]) - 4:
+                        values = None
+                        break
+        if values is None:
+            elements = list(iter_bson_elements(doc))
+            shape = tuple([ (value_type, key) for (value_type, key, value) in elements ])
+            values = tuple([ value for (value_type, key, value) in elements ])
+            if shape not in shapes:
+                shapes[shape] = len(shape_list)
+                shape_list.append(shape)
+                patterns.append(compile_timeseries_shape(shape))
+            shape_id = shapes[shape]
+            (pattern, string_fields) = patterns[shape_id]
+        shape_ids.append(shape_id)
+        rows.append(values)
+    if len(shape_list) == 1 and len(set(shape_list[0])) == len(shape_list[0]):
+        # A single shape, the columns are the rows transposed
+        column_list = list(shape_list[0])
+        columns = dict(zip(column_list, zip(*rows)))
+    else:
+        columns = {}
+        column_list = []
+        for (one_shape_id, values) in itertools.izip(shape_ids, rows):
+            for (field, value) in itertools.izip(shape_list[one_shape_id], values):
+                if field not in columns:
+                    columns[field] = []
+                    column_list.append(field)
+                columns[field].append(value)
+    out = [ struct.pack("<I", len(shape_list)) ]
+    for shape in shape_list:
+        out.append(struct.pack("<I", len(shape)))
+        for (value_type, key) in shape:
+            out.append(chr(value_type) + key + "\x00")
+    out.append(shuffle_bytes(struct.pack("<%dI" % (len(shape_ids)), *shape_ids), 4))
+    out.append(struct.pack("<I", len(column_list)))
+    for (value_type, key) in column_list:
+        values = columns[(value_type, key)]
+        data = encode_timeseries_column(value_type, values)
+        out.append(chr(value_type) + key + "\x00" + struct.pack("<II", len(values), len(data)))
+        out.append(data)
+    return "".join(out)
+
+def encode_timeseries_column(value_type, values):
+    '''
+    Encode the values of one column, depending on their BSON type:
+      - dates and 64 bit integers, as the deltas between values
+      - 32 bit integers, as the deltas between values
+      - doubles, XORed with the previous value
+      - strings, like the hosts, as indexes in a dictionary of the values
+      - any other type, as the values one after the other
+    The numbers are stored by bytes of same weight, which zlib compresses
+    better than the numbers themselves.
+    :param value_type: BSON type of the values
+    :param values: list of the BSON encoded values
+    '''
+    count = len(values)
+    # The numbers are paired with the previous ones with 'map', in C
+    if value_type in (0x09, 0x12):
+        numbers = struct.unpack("<%dQ" % (count), "".join(values))
+        deltas = map(INT64_MASK.__and__, map(operator.sub, numbers, (0,) + numbers[:-1]))
+        return shuffle_bytes(struct.pack("<%dQ" % (count), *deltas), 8)
+    if value_type == 0x10:
+        numbers = struct.unpack("<%di" % (count), "".join(values))
+        deltas = map(operator.sub, numbers, (0,) + numbers[:-1])
+        return shuffle_bytes(struct.pack("<%dq" % (count), *deltas), 8)
+    if value_type == 0x01:
+        numbers = struct.unpack("<%dQ" % (count), "".join(values))
+        xors = map(operator.xor, numbers, (0,) + numbers[:-1])
+        return shuffle_bytes(struct.pack("<%dQ" % (count), *xors), 8)
+    if value_type == 0x02:
+        words = {}
+        word_list = []
+        indexes = []
+        for value in values:
+            if value not in words:
+                words[value] = len(word_list)
+                word_list.append(value)
+            indexes.append(words[value])
+        return struct.pack("<I", len(word_list)) + "".join(word_list) + shuffle_bytes(struct.pack("<%dI" % (count), *indexes), 4)
+    return "".join(values)
+
+def encode_timeseries_dump(directory, jobs):
+    '''
+    Encode the collections of the metrics DBs, METRICS_DBS, with
+    'encode_timeseries', replacing each ".bson" file with a TIMESERIES_EXT
+    file. A collection that can't be encoded is left as it is.
+    The manifest must be written before, so the importer verifies the
+    decoded collections against the original ones.
+    The blocks are encoded by a pool of up to 'jobs' processes, one per
+    CPU, as the encoding is pure Python and threads would wait on each other.
+    :param directory: directory where the "dump" dir is located
+    :param jobs: number of processes encoding the blocks
+    '''
+    print "Encoding metrics...",
+    if Norun:
+        print "  done."
+        return
+    members = []
+    for member in list_dump_files(directory):
+        namespace = member_namespace(member)
+        if namespace is None or not member.endswith(".bson"):
+            continue
+        for metrics_db in METRICS_DBS:
+            if re.search(metrics_db, namespace[0]):
+                members.append(member)
+                break
+    def encode_one(member):
+        bson_path = os.path.join(directory, *member.split('/'))
+        target = bson_path[:-len(".bson")] + TIMESERIES_EXT
+        try:
+            encode_timeseries(bson_path, target, pool, jobs)
+        except Exception, e:
+            warning("Can't encode %s, leaving it as is: %s" % (member, e))
+            if os.path.exists(target):
+                os.remove(target)
+            return (0, 0)
+        sizes = (os.path.getsize(bson_path), os.path.getsize(target))
+        os.remove(bson_path)
+        return sizes
+    jobs = min(jobs, multiprocessing.cpu_count())
+    pool = None
+    if jobs > 1 and members:
+        pool = multiprocessing.Pool(jobs)
+    try:
+        sizes = [ encode_one(member) for member in members ]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    print "  done."
+    if Verbose:
+        sizes = [ one_size for one_size in sizes if one_size[1] ]
+        before = sum([ one_size[0] for one_size in sizes ])
+        after = sum([ one_size[1] for one_size in sizes ])
+        print "  encoded %d collections, from %d MB to %d MB" % (len(sizes), before / (1024 * 1024), after / (1024 * 1024))
+
 def export_additional_data(mongoexport, auth_string, host, port, dump_dir, caseid):
     '''
     Export additional data.
@@ -177,6 +802,151 @@ def export_additional_data(mongoexport, auth_string, host, port, dump_dir, casei
             if db == COLLECTION_WITH_GROUPS[0] and coll == COLLECTION_WITH_GROUPS[1]:
                 replace_string(json_file, '"n" : "', '"n" : "%s-' % (caseid))
     
+def export_data_files(paths, auth_string, host, port, directory, caseid, options):
+    '''
+    Export the data files of the MMS database instead of dumping it, when
+    running on the database host. This avoids 'mongodump' serializing
+    every document, which is most of the time of a large export.
+    The server is locked with 'fsyncLock' while the files are copied,
+    unless '--snapshot' says they are from a filesystem snapshot or a
+    stopped server. The copy is then cleaned with 'clean_data_files'.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param host: host where the source MMS instance is.
+    :param port: port to access the database.
+    :param directory: directory where to put the "dump" dir.
+    :param caseid: case ID to associate the data with.
+    :param options: command line options.
+    '''
+    data_dir = os.path.join(directory, DUMPDIR, PHYSICAL_DIR)
+    print "Copying data files...",
+    if Norun:
+        print "  done."
+        return
+    os.makedirs(data_dir)
+    if options.snapshot:
+        copy_data_files(options.dbpath, data_dir, options.jobs)
+    else:
+        run_mongoshell_cmd(paths['mongo'], auth_string, host, port, "admin", "db.fsyncLock().ok")
+        try:
+            copy_data_files(options.dbpath, data_dir, options.jobs)
+        finally:
+            run_mongoshell_cmd(paths['mongo'], auth_string, host, port, "admin", "db.fsyncUnlock().ok")
+    print "  done."
+    clean_data_files(paths, directory, caseid)
+
+def export_fleet(paths, options):
+    '''
+    Export all the MMS instances of an inventory file, several at once.
+    Each instance is exported in a sub directory named after its case ID.
+    Before starting an instance, the space it needs is reserved on the
+    budget of the output directory, and the instance waits until enough
+    space is free. A summary of all the exports is shown at the end.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param options: command line options.
+    '''
+    instances = read_inventory(options.inventory)
+    print "Exporting %d MMS instances, %d at a time" % (len(instances), options.workers)
+    budget = DiskBudget(options.directory)
+    def export_one(instance):
+        start = time.time()
+        name = "%s:%s" % (instance['host'], instance['port'])
+        directory = os.path.join(options.directory, instance['caseid'])
+        reserved = False
+        status = "ok"
+        try:
+            try:
+                if not os.path.isdir(directory):
+                    os.mkdir(directory)
+                auth_string = get_auth_string(instance['username'], instance['password'])
+                if not options.nocheck:
+                    space_needed = get_space_needed(paths, auth_string, instance['host'], instance['port'])
+                    budget.reserve(space_needed, name, directory)
+                    reserved = True
+                print "Exporting %s for case %s" % (name, instance['caseid'])
+                export_instance(paths, auth_string, instance['host'], instance['port'], directory, instance['caseid'], options)
+            except SystemExit:
+                # 'fatal' already printed the reason
+                status = "FAILED"
+            except Exception, e:
+                error("export of %s failed: %s" % (name, e))
+                status = "FAILED: %s" % (str(e).split("\n")[0])
+        finally:
+            if reserved:
+                budget.release(directory)
+        return (name, instance['caseid'], status, time.time() - start, get_dir_size(os.path.join(directory, DUMPDIR)))
+    start = time.time()
+    results = parallel_map(export_one, instances, options.workers)
+    print "\nSummary:"
+    failures = 0
+    for (name, caseid, status, elapsed, size) in results:
+        print "  %-30s case %-10s %6ds %8d MB  %s" % (name, caseid, elapsed, size / (1024 * 1024), status)
+        if status != "ok":
+            failures += 1
+    print "  %d exported, %d failed, in %ds" % (len(results) - failures, failures, time.time() - start)
+
+def export_instance(paths, auth_string, host, port, directory, caseid, options):
+    '''
+    Export one MMS instance: dump it, clean the dump and add the additional
+    data, then package and ship it if asked.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param host: host where the source MMS instance is.
+    :param port: port to access the database.
+    :param directory: directory where to put the "dump" dir and the package.
+    :param caseid: case ID to associate the data with.
+    :param options: command line options.
+    '''
+    dump_dir = os.path.join(directory, DUMPDIR)
+    for one_dump_dir in [ dump_dir ] + [ os.path.join(spool, DUMPDIR) for spool in options.spool ]:
+        if os.path.exists(one_dump_dir):
+            if options.force:
+                safe_rm_tree(one_dump_dir)
+            else:
+                fatal("You must use '--force' OR remove manually the directory: %s" % (one_dump_dir))
+    if options.dbpath:
+        export_data_files(paths, auth_string, host, port, directory, caseid, options)
+    else:
+        if options.shards:
+            shards = get_shards(paths['mongo'], auth_string, host, port)
+            if not shards:
+                fatal("'--shards' needs '--host' and '--port' to be a 'mongos'")
+            dump_shards(paths, auth_string, host, port, directory, shards, options)
+        elif options.maxrate or options.maxlatency or options.readers > 1 or options.spool:
+            dbs = list_mms_dbs(paths['mongo'], auth_string, host, port)
+            spools = [ directory ] + options.spool
+            dump_database_throttled(paths['mongodump'], auth_string, host, port, directory, dbs, options.readers, options.maxrate, options.maxlatency, options.readpref, spools)
+        else:
+            dump_database(paths['mongodump'], auth_string, host, port, directory, options.readpref)
+        clean_dumped_data(dump_dir)
+        export_additional_data(paths['mongoexport'], auth_string, host, port, dump_dir, caseid)
+    write_mms_version(dump_dir)
+    write_import_data(dump_dir, caseid)
+    write_manifest(directory, options.jobs)
+    if options.store:
+        recipe = caseid or "export-%d" % (time.time())
+        new_chunks = store_dump(directory, options.store, recipe, options.jobs)
+        if options.ship or options.zip:
+            zipfile = package_delta(directory, options.store, recipe, new_chunks)
+    elif options.ship or options.zip:
+        if options.compact:
+            encode_timeseries_dump(directory, options.jobs)
+        zipfile = package(directory, caseid, options.format, options.jobs)
+    if options.ship:
+        ship(zipfile, caseid)
+
+def get_auth_string(username, password):
+    '''
+    Return the authentication options for the MongoDB tools.
+    :param username: username for a secured MMS DB, may be empty.
+    :param password: password for a secured MMS DB, may be empty.
+    '''
+    auth_string = ''
+    if username or password:
+        if not username or not password:
+            fatal("You must provide both: --username and --password")
+        else:
+            auth_string = "--username %s --password %s --authenticationDatabase %s" % (username, password, AUTH_DB)
+    return auth_string
+
 def get_avail_space(directory):
     '''
     Return the available space on the target directory where we will
@@ -190,6 +960,36 @@ def get_avail_space(directory):
         print "Space available on disk: %d MB" % (df)
     return df
 
+def get_total_avail_space(directories):
+    '''
+    Return the available space in MB of several directories, counting once
+    the directories on the same file system.
+    :param directories: list of the directories
+    '''
+    total = 0
+    devices = []
+    for directory in directories:
+        device = os.stat(directory).st_dev
+        if device not in devices:
+            devices.append(device)
+            total += get_avail_space(directory)
+    return total
+
+def get_dir_size(directory):
+    '''
+    Return the size in bytes of all the files under a directory.
+    :param directory: directory to measure, 0 if it does not exist.
+    '''
+    size = 0
+    for (root, dirs, names) in os.walk(directory, followlinks=True):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # File removed while we walk the tree
+                pass
+    return size
+
 def get_dbs_space(mongoshell, auth_string, host, port):
     '''
     Get the space used by all DBs we want to export
@@ -275,21 +1075,342 @@ def get_mms_version(dump_dir):
         print "MMS version is %s" % (version)
     return version
     
-def package(directory, zipname):
+def get_seed(shard_host):
+    '''
+    Return the (host, port) of the first member of a shard.
+    :param shard_host: host of the shard, like 'rs0/host1:27018,host2:27018'
+    '''
+    member = shard_host.split("/")[-1].split(",")[0]
+    if ":" in member:
+        return tuple(member.split(":", 1))
+    return (member, "27017")
+
+def get_shard_queries(mongoshell, auth_string, host, port, directory):
+    '''
+    Return the sharded collections, and the query on the chunk ranges each
+    shard owns, read from the "config" DB by SHARD_QUERIES_JS.
+    The chunks of a hashed shard key can't be turned into a query on the
+    documents, so these collections are dumped whole from each shard.
+    Return a tuple of the namespaces of the sharded collections that have
+    a query, and a dict of the queries by (namespace, shard).
+    :param mongoshell: path to the mongoshell command.
+    :param host: host of the 'mongos'.
+    :param port: port of the 'mongos'.
+    :param directory: directory where to write the script.
+    '''
+    script = os.path.join(directory, "shard_queries.js")
+    script_file = open(script, 'w')
+    script_file.write(SHARD_QUERIES_JS)
+    script_file.close()
+    (_, out) = run_cmd("%s %s --quiet --host %s --port %s config %s" % (mongoshell, auth_string, host, port, script), abort=True, norun=Norun)
+    sharded = []
+    queries = {}
+    for one_line in out:
+        fields = one_line.split("\t", 2)
+        if len(fields) != 3:
+            continue
+        (namespace, shard, query) = fields
+        if shard:
+            queries[(namespace, shard)] = query
+        elif query == "hashed":
+            warning("Collection %s has a hashed shard key, its orphaned documents can't be left out of the dump" % (namespace))
+        else:
+            sharded.append(namespace)
+    if Verbose:
+        print "Sharded collections: %d, queries on the shards: %d" % (len(sharded), len(queries))
+    return (sharded, queries)
+
+def get_shards(mongoshell, auth_string, host, port):
+    '''
+    Return the shards behind a 'mongos', as a list of (name, host) where
+    host is like 'rs0/host1:27018,host2:27018' for a replica set, or None
+    if the server is not a 'mongos'.
+    :param mongoshell: path to the mongoshell command.
+    :param host: host of the 'mongos'.
+    :param port: port of the 'mongos'.
+    '''
+    (_, out) = run_mongoshell_cmd(mongoshell, auth_string, host, port, "admin", "db.isMaster().msg == 'isdbgrid'")
+    if not out or out[0].strip() != "true":
+        return None
+    (_, out) = run_mongoshell_cmd(mongoshell, auth_string, host, port, "config", "sh.getBalancerState()")
+    if out and out[0].strip() == "true":
+        warning("The balancer is enabled, the chunks moved during the export may be missing or duplicated. Run 'sh.stopBalancer()' first for a consistent export")
+    shards = []
+    name = None
+    cmd = "db.shards.find().toArray()"
+    (_, out) = run_mongoshell_cmd(mongoshell, auth_string, host, port, "config", cmd)
+    for one_line in out:
+        m = re.search(r'"_id"\s*:\s*"(.+)"', one_line)
+        if m:
+            name = m.group(1)
+        m = re.search(r'"host"\s*:\s*"(.+)"', one_line)
+        if m:
+            shards.append((name, m.group(1)))
+    if Verbose:
+        for (name, shard_host) in shards:
+            print "Shard: %s, %s" % (name, shard_host)
+    return shards
+
+def get_space_needed(paths, auth_string, host, port):
+    '''
+    Return the disk space in MB needed to export an MMS instance.
+    We need 1x for the data, 1x or less for the zip, and we give ourselves
+    some margin.
+    :param paths: paths of the tools, from 'find_paths'.
+    :param host: host where the DB is located.
+    :param port: port to access the DB.
+    '''
+    return get_dbs_space(paths['mongo'], auth_string, host, port) * 3
+
+def iter_chunks(filepath):
+    '''
+    Generator returning the chunks of a file for the deduplicating store.
+    The chunks of a ".bson" file end on document boundaries chosen from the
+    content of the documents: a document ends a chunk when its CRC32 is
+    below a threshold proportional to its size. So inserting or removing
+    documents only changes the chunks around them, and the chunks are about
+    CHUNK_AVG bytes, between CHUNK_MIN and CHUNK_MAX. Other files are cut
+    every CHUNK_MAX bytes.
+    :param filepath: file to cut in chunks
+    '''
+    in_file = open(filepath, 'rb')
+    if filepath.endswith(".bson"):
+        cut_threshold = (1 << 32) / CHUNK_AVG
+        chunk = []
+        size = 0
+        while True:
+            header = in_file.read(4)
+            if not header:
+                break
+            doc = header
+            if len(header) == 4:
+                doc += in_file.read(struct.unpack("<i", header)[0] - 4)
+            if len(doc) < 5 or len(doc) != struct.unpack("<i", doc[:4])[0]:
+                in_file.close()
+                raise Exception("Truncated BSON file: %s" % (filepath))
+            chunk.append(doc)
+            size += len(doc)
+            if size >= CHUNK_MAX or (size >= CHUNK_MIN and (zlib.crc32(doc) & 0xffffffffL) < len(doc) * cut_threshold):
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+    else:
+        while True:
+            data = in_file.read(CHUNK_MAX)
+            if not data:
+                break
+            yield data
+    in_file.close()
+
+def list_mms_dbs(mongoshell, auth_string, host, port):
+    '''
+    Return the names of the MMS databases on the server.
+    :param mongoshell: path to the mongoshell command.
+    :param host: host where the DB is located.
+    :param port: port to access the DB.
+    '''
+    dbs = []
+    cmd = "db.adminCommand('listDatabases').databases"
+    (_, out) = run_mongoshell_cmd(mongoshell, auth_string, host, port, "test", cmd)
+    for one_line in out:
+        m = re.search(r'"name"\s*:\s*"(.+)"', one_line)
+        if m:
+            for ok_db in ALL_MMS_DBS:
+                if re.search(ok_db, m.group(1)):
+                    dbs.append(m.group(1))
+                    break
+    return dbs
+
+def merge_shard_dumps(shard_dirs, directory):
+    '''
+    Merge the dumps of the shards into the "dump" dir.
+    The documents of a collection sharded across several shards are
+    concatenated in a single ".bson" file, as each shard only dumped the
+    chunks it owns. The other files, like the metadata and
+    "system.indexes", are the same on all shards and the first one is kept.
+    :param shard_dirs: directories where the "dump" dir of each shard is located
+    :param directory: directory where to put the merged "dump" dir.
+    '''
+    for shard_dir in shard_dirs:
+        for member in list_dump_files(shard_dir):
+            source = os.path.join(shard_dir, *member.split('/'))
+            target = os.path.join(directory, *member.split('/'))
+            if not os.path.exists(target):
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(source, target)
+            elif member.endswith(".bson") and not member.endswith("/system.indexes.bson"):
+                source_file = open(source, 'rb')
+                target_file = open(target, 'ab')
+                shutil.copyfileobj(source_file, target_file, IO_BUFSIZE)
+                target_file.close()
+                source_file.close()
+
+def pack_timeseries_block(docs):
+    '''
+    Return a block of documents encoded by 'encode_timeseries_block' and
+    compressed, after its header with the count of documents and the size.
+    Run in the processes of the pool of 'encode_timeseries_dump'.
+    :param docs: list of BSON documents
+    '''
+    data = zlib.compress(encode_timeseries_block(docs))
+    return struct.pack("<II", len(docs), len(data)) + data
+
+def package(directory, zipname, archive_format="gzip", jobs=1):
     '''
     Create a Zip file of the data.
     :param directory: directory to Zip
     :param zipname: CS-xxxxx case the customer has open with us in case
                     the file is shipped, otherwise 'mongo_mms_data'.
+    :param archive_format: 'gzip' for a tar.gz, 'indexed' for an archive
+                           with a table of contents, see 'write_archive'.
+    :param jobs: number of files to compress in parallel, for 'indexed'.
+                 A tar.gz is a single stream, written by one thread.
     '''
     print "Packaging...",
-    target = os.path.join(directory, zipname + ".gzip")
-    tar = tarfile.open(target, "w:gz")
-    tar.add(os.path.join(directory, DUMPDIR))    
-    tar.close()
+    if archive_format == "indexed":
+        target = os.path.join(directory, zipname + ARCHIVE_EXT)
+        write_archive(directory, target, jobs)
+    else:
+        target = os.path.join(directory, zipname + ".gzip")
+        # The dirs of the spools are links, archive their contents
+        tar = tarfile.open(target, "w:gz", dereference=True)
+        tar.add(os.path.join(directory, DUMPDIR))    
+        tar.close()
     print "  done."
     return target
     
+def package_delta(directory, store, recipe, new_chunks):
+    '''
+    Create a pack with a recipe of the store and the chunks that were new
+    in the store. A receiving store which has the previous packs only needs
+    this one to rebuild the dump.
+    The chunks are already compressed, so the pack is a plain tar file.
+    :param directory: directory where to create the pack
+    :param store: directory of the deduplicating store
+    :param recipe: name of the recipe
+    :param new_chunks: SHA1s of the chunks which were not in the store
+    '''
+    print "Packaging new data...",
+    target = os.path.join(directory, recipe + PACK_EXT)
+    tar = tarfile.open(target, "w")
+    tar.add(os.path.join(store, STORE_RECIPES, recipe), "/".join((STORE_RECIPES, recipe)))
+    for one_chunk in new_chunks:
+        chunk_member = "/".join((STORE_CHUNKS, one_chunk[:2], one_chunk))
+        tar.add(os.path.join(store, *chunk_member.split("/")), chunk_member)
+    tar.close()
+    print "  done."
+    return target
+
+def pause_processes(processes, duration):
+    '''
+    Suspend processes for some time, with SIGSTOP and SIGCONT.
+    :param processes: list of 'subprocess.Popen' objects.
+    :param duration: pause in seconds.
+    '''
+    for process in processes:
+        os.kill(process.pid, signal.SIGSTOP)
+    try:
+        time.sleep(duration)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                os.kill(process.pid, signal.SIGCONT)
+
+def pick_spool(spools, running, stats):
+    '''
+    Return the spool dir to dump the next database to.
+    Among the dirs with at least MIN_DISK_SPACE MB free, it is the one with
+    the fewest dumps running for the throughput measured on it. The dirs
+    not measured yet are tried first.
+    :param spools: list of the spool dirs
+    :param running: spool dir of each dump running
+    :param stats: (bytes, seconds) dumped so far, by spool dir
+    '''
+    candidates = [ spool for spool in spools if get_avail_space(spool) >= MIN_DISK_SPACE ]
+    if not candidates:
+        warning("All the spool dirs have less than %d MB free" % (MIN_DISK_SPACE))
+        candidates = list(spools)
+    def load(spool):
+        (size, seconds) = stats[spool]
+        if not size or not seconds:
+            return (0, running.count(spool))
+        return (1, (running.count(spool) + 1) / (size / seconds))
+    candidates.sort(key=load)
+    return candidates[0]
+
+def probe_latency(host, port):
+    '''
+    Return the time in ms the server takes to answer an 'isMaster' command,
+    or None if it did not answer within PROBE_TIMEOUT seconds.
+    The command is sent with the wire protocol, to not start a mongo shell
+    for each probe. It needs no authentication.
+    :param host: host to probe.
+    :param port: port to probe.
+    '''
+    elements = "\x10isMaster\x00" + struct.pack("<i", 1)
+    query = struct.pack("<i", len(elements) + 5) + elements + "\x00"
+    # OP_QUERY on admin.$cmd, returning one document
+    body = struct.pack("<i", 0) + "admin.$cmd\x00" + struct.pack("<ii", 0, -1) + query
+    message = struct.pack("<iiii", len(body) + 16, 1, 0, 2004) + body
+    start = time.time()
+    sock = None
+    try:
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(PROBE_TIMEOUT)
+            sock.connect((host, int(port)))
+            start = time.time()
+            sock.sendall(message)
+            header = ""
+            while len(header) < 4:
+                data = sock.recv(4 - len(header))
+                if not data:
+                    return None
+                header += data
+            remaining = struct.unpack("<i", header)[0] - 4
+            while remaining > 0:
+                data = sock.recv(min(remaining, 65536))
+                if not data:
+                    return None
+                remaining -= len(data)
+        except socket.error:
+            return None
+    finally:
+        if sock is not None:
+            sock.close()
+    return (time.time() - start) * 1000
+
+def read_inventory(inventory):
+    '''
+    Read the list of MMS instances to export.
+    Each line is: HOST PORT CASEID [USERNAME PASSWORD]. Empty lines and lines
+    starting with '#' are ignored.
+    Return a list of dicts with the keys 'host', 'port', 'caseid', 'username'
+    and 'password'.
+    :param inventory: path of the inventory file.
+    '''
+    instances = []
+    caseids = dict()
+    inventory_file = open(inventory, 'r')
+    line_num = 0
+    for line in inventory_file:
+        line_num += 1
+        items = line.split()
+        if not items or items[0].startswith("#"):
+            continue
+        if len(items) not in (3, 5):
+            fatal("%s, line %d: expecting HOST PORT CASEID [USERNAME PASSWORD]" % (inventory, line_num))
+        if items[2] in caseids:
+            fatal("%s, line %d: case ID %s is used twice" % (inventory, line_num, items[2]))
+        caseids[items[2]] = True
+        items.extend([ "", "" ])
+        instances.append({'host':get_host(items[0]), 'port':items[1], 'caseid':items[2], 'username':items[3], 'password':items[4]})
+    inventory_file.close()
+    return instances
+
 def run_mongoshell_cmd(mongoshell, auth_string, host, port, db, cmd, norun=Norun):
     '''
     Run a command in the Mongo shell and return the result as an
@@ -340,6 +1461,153 @@ def ship(zipfile, caseid):
     os.remove(zipfile)
     print "  done."
 
+def store_dump(directory, store, recipe, jobs):
+    '''
+    Add the "dump" tree to a content addressed store, so repeated exports
+    of the same MMS instance only add the data which changed.
+    Each file is cut in chunks, see 'iter_chunks', and each chunk is saved
+    compressed as STORE_CHUNKS/<2 first chars of SHA1>/<SHA1>, unless it is
+    already in the store. The recipe, saved as STORE_RECIPES/<recipe>, lists
+    the chunks of each file, one line per file: the path, a tab, and the
+    SHA1s of its chunks separated by commas.
+    Return the SHA1s of the chunks which were not in the store.
+    :param directory: directory where the "dump" dir is located
+    :param store: directory of the deduplicating store
+    :param recipe: name of the recipe, usually the case ID
+    :param jobs: number of files to process in parallel
+    '''
+    print "Adding the dump to the store...",
+    recipes_dir = os.path.join(store, STORE_RECIPES)
+    if not os.path.isdir(recipes_dir):
+        os.makedirs(recipes_dir)
+    def store_file(member):
+        chunks = []
+        new_chunks = []
+        for chunk in iter_chunks(os.path.join(directory, *member.split("/"))):
+            checksum = new_checksum(chunk).hexdigest()
+            if write_chunk(store, checksum, chunk):
+                new_chunks.append((checksum, len(chunk)))
+            chunks.append(checksum)
+        return (member, chunks, new_chunks)
+    results = parallel_map(store_file, list_dump_files(directory), jobs)
+    recipe_path = os.path.join(recipes_dir, recipe)
+    recipe_file = open(recipe_path + ".tmp", 'w')
+    new_chunks = []
+    new_size = 0
+    seen = dict()
+    for (member, chunks, file_new_chunks) in results:
+        recipe_file.write("%s\t%s\n" % (member, ",".join(chunks)))
+        for (checksum, size) in file_new_chunks:
+            # Two threads may both have written the same new chunk
+            if checksum not in seen:
+                seen[checksum] = True
+                new_chunks.append(checksum)
+                new_size += size
+    recipe_file.close()
+    os.rename(recipe_path + ".tmp", recipe_path)
+    print "  done."
+    print "  %d new chunks, %d MB of new data" % (len(new_chunks), new_size / (1024 * 1024))
+    return new_chunks
+
+def write_archive(directory, target, jobs=1):
+    '''
+    Write the "dump" tree in the indexed archive format.
+    Unlike a tar.gz, each file is compressed on its own and the archive ends
+    with a table of contents, so the importer can list it, or extract one
+    collection, without decompressing everything. The layout is:
+      - ARCHIVE_MAGIC
+      - one zlib stream per file
+      - the index, one line per file with the path, offset, compressed size,
+        size, document count and SHA1, separated by tabs
+      - the offset and length of the index, followed by ARCHIVE_TRAILER
+    With several jobs, the files are compressed in parallel, so they are
+    read from all the spool dirs at once. Each one is compressed in a
+    temporary file next to it, then appended to the archive. The index
+    gives the offsets, so the order of the files does not matter.
+    :param directory: directory where the "dump" dir is located
+    :param target: path of the archive to create
+    :param jobs: number of files to compress in parallel
+    '''
+    out = open(target, 'wb')
+    out.write(ARCHIVE_MAGIC)
+    lock = threading.Lock()
+    def add_member(member):
+        filepath = os.path.join(directory, member)
+        docs = count_docs(filepath)
+        if jobs <= 1:
+            offset = out.tell()
+            (size, checksum) = write_archive_member(out, filepath)
+            csize = out.tell() - offset
+        else:
+            compressed = tempfile.TemporaryFile(dir=os.path.dirname(os.path.realpath(filepath)))
+            (size, checksum) = write_archive_member(compressed, filepath)
+            compressed.seek(0)
+            lock.acquire()
+            try:
+                offset = out.tell()
+                shutil.copyfileobj(compressed, out, IO_BUFSIZE)
+                csize = out.tell() - offset
+            finally:
+                lock.release()
+            compressed.close()
+        return "%s\t%d\t%d\t%d\t%d\t%s\n" % (member, offset, csize, size, docs, checksum)
+    index = parallel_map(add_member, list_dump_files(directory), jobs)
+    index_offset = out.tell()
+    index_data = "".join(index)
+    out.write(index_data)
+    out.write(struct.pack(">QQ", index_offset, len(index_data)) + ARCHIVE_TRAILER)
+    out.close()
+
+def write_archive_member(out, filepath):
+    '''
+    Append one file as an independent zlib stream to an open archive.
+    Return the uncompressed size and the SHA1 of the file.
+    :param out: archive file, opened for writing
+    :param filepath: file to compress
+    '''
+    size = 0
+    checksum = new_checksum()
+    compressor = zlib.compressobj(6)
+    in_file = open(filepath, 'rb')
+    while True:
+        data = in_file.read(IO_BUFSIZE)
+        if not data:
+            break
+        size += len(data)
+        checksum.update(data)
+        out.write(compressor.compress(data))
+    in_file.close()
+    out.write(compressor.flush())
+    return size, checksum.hexdigest()
+
+def write_chunk(store, checksum, chunk):
+    '''
+    Save a chunk in the store, compressed, if it is not already there.
+    Return True if the chunk was new.
+    The chunk is written under a temporary name and renamed, so concurrent
+    exports into the same store never see a partial chunk.
+    :param store: directory of the deduplicating store
+    :param checksum: SHA1 of the chunk
+    :param chunk: data of the chunk
+    '''
+    chunk_path = os.path.join(store, STORE_CHUNKS, checksum[:2], checksum)
+    if os.path.exists(chunk_path):
+        return False
+    chunk_dir = os.path.dirname(chunk_path)
+    if not os.path.isdir(chunk_dir):
+        try:
+            os.makedirs(chunk_dir)
+        except OSError:
+            # Another thread may have created it
+            if not os.path.isdir(chunk_dir):
+                raise
+    tmp_path = "%s.%d.%s" % (chunk_path, os.getpid(), threading.currentThread().getName())
+    chunk_file = open(tmp_path, 'wb')
+    chunk_file.write(zlib.compress(chunk, 6))
+    chunk_file.close()
+    os.rename(tmp_path, chunk_path)
+    return True
+
 def write_import_data(dump_dir, case_id):
     '''
     Write some additional data regarding this export, so it can be tracked
@@ -360,6 +1628,28 @@ def write_import_data(dump_dir, case_id):
         data_file.write(doc_to_json(doc) + "\n")
         data_file.close()
     
+def write_manifest(directory, jobs):
+    '''
+    Write the manifest of the "dump" tree, so the importer can verify the
+    data before restoring it, and check the counts once it is restored.
+    There is one line per file with its path, size, document count and
+    SHA1, separated by tabs. The files are checksummed in parallel.
+    :param directory: directory where the "dump" dir is located
+    :param jobs: number of files to checksum in parallel
+    '''
+    print "Writing manifest...",
+    if not Norun:
+        members = list_dump_files(directory)
+        manifest_member = "/".join((DUMPDIR, MANIFEST_FILE))
+        if manifest_member in members:
+            members.remove(manifest_member)
+        entries = parallel_map(lambda member: get_file_info(directory, member), members, jobs)
+        manifest_file = open(os.path.join(directory, DUMPDIR, MANIFEST_FILE), 'w')
+        for entry in entries:
+            manifest_file.write("%s\t%d\t%d\t%s\n" % (entry['path'], entry['size'], entry['docs'], entry['sha1']))
+        manifest_file.close()
+    print "  done."
+
 def write_mms_version(dump_dir):
     '''
     Write the MMS version in a file, so the importer knows how to import the data.
@@ -390,42 +1680,54 @@ def main():
     if options.norun:
         global Norun
         Norun = True
-    if (options.ship or options.zip) and not options.caseid:
+    if options.profile:
+        start_profiling(options.profile)
+    if options.readers < 1 or options.maxrate < 0 or options.maxlatency < 0:
+        fatal("'--readers' must be at least 1, '--maxrate' and '--maxlatency' can't be negative")
+    if options.readpref and options.readpref not in READ_PREFERENCES:
+        fatal("'--readpref' must be one of: %s" % (", ".join(READ_PREFERENCES)))
+    if (options.ship or options.zip) and not options.caseid and not options.inventory:
         fatal("You must provide a '-caseid' in order to ship or create a shippable package")
-    auth_string = ''
-    if options.username or options.password:
-        if not options.username or not options.password:
-            fatal("You must provide both: --username and --password")
-        else:
-            auth_string = "--username %s --password %s --authenticationDatabase %s" % (options.username, options.password, AUTH_DB)
+    if options.inventory and options.ship:
+        fatal("'--ship' asks for a password for each package, use '--zip' with '--inventory'")
+    if options.workers < 1:
+        fatal("'--workers' must be at least 1")
+    if options.shardjobs < 0:
+        fatal("'--shardjobs' can't be negative")
+    if options.dbpath and not os.path.isdir(options.dbpath):
+        fatal("Can't find the data files directory: %s" % (options.dbpath))
+    for spool in options.spool:
+        if not os.path.isdir(spool):
+            fatal("Can't find the spool directory: %s" % (spool))
+        if os.path.realpath(spool) == os.path.realpath(options.directory) or options.spool.count(spool) > 1:
+            fatal("The spool directories must differ from each other and from '--directory': %s" % (spool))
+    if options.spool and (options.dbpath or options.shards or options.inventory):
+        fatal("'--spool' can't be used with '--dbpath', '--shards' or '--inventory'")
+    if options.dbpath and (options.shards or options.inventory):
+        fatal("'--dbpath' can't be used with '--shards' or '--inventory'")
+    if options.compact and options.store:
+        warning("'--compact' is ignored with '--store', the store keeps the collections as they are dumped")
+    auth_string = get_auth_string(options.username, options.password)
     try:
-        options.host = get_host(options.host)
-        dump_dir = os.path.join(options.directory, DUMPDIR)
-        if os.path.exists(dump_dir):
-            if options.force:
-                safe_rm_tree(dump_dir)
-            else:
-                fatal("You must use '--force' OR remove manually the directory: %s" % (dump_dir))
         paths = find_paths(DEPS)
-        if not options.nocheck:
-            space_avail = get_avail_space(options.directory)
-            if space_avail < MIN_DISK_SPACE:
-                fatal("Disk should have at least ~%d MBytes free, there is only %d MBytes available on disk" % (MIN_DISK_SPACE, space_avail))
-            space_dbs = get_dbs_space(paths['mongo'], auth_string, options.host, options.port)
-            # We need 1x for the data, 1x or less for the zip, and we give ourselves some margin
-            space_needed = space_dbs * 3
-            if space_avail < space_needed:
-                fatal("Export needs ~%d MBytes free, there is only %d MBytes available on disk" % (space_needed, space_avail))
-        dump_database(paths['mongodump'], auth_string, options.host, options.port, options.directory)
-        clean_dumped_data(dump_dir)
-        export_additional_data(paths['mongoexport'], auth_string, options.host, options.port, dump_dir, options.caseid)
-        write_mms_version(dump_dir)
-        write_import_data(dump_dir, options.caseid)
-        if options.ship:
-            zipfile = package(options.directory, options.caseid)
-            ship(zipfile, options.caseid)
-        elif options.zip:
-            zipfile = package(options.directory, options.caseid)
+        if options.dbpath:
+            paths.update(find_paths(("mongod",)))
+        if options.inventory:
+            export_fleet(paths, options)
+        else:
+            options.host = get_host(options.host)
+            if not options.nocheck:
+                space_avail = get_total_avail_space([ options.directory ] + options.spool)
+                if space_avail < MIN_DISK_SPACE:
+                    fatal("Disk should have at least ~%d MBytes free, there is only %d MBytes available on disk" % (MIN_DISK_SPACE, space_avail))
+                if options.dbpath:
+                    # Same margin as a dump, for the package and the repairs
+                    space_needed = get_dir_size(options.dbpath) / (1024 * 1024) * 3
+                else:
+                    space_needed = get_space_needed(paths, auth_string, options.host, options.port)
+                if space_avail < space_needed:
+                    fatal("Export needs ~%d MBytes free, there is only %d MBytes available on disk" % (space_needed, space_avail))
+            export_instance(paths, auth_string, options.host, options.port, options.directory, options.caseid, options)
             
     except AuthException, e:
         error("caught authentication exception:\n" + 
@@ -470,6 +1772,285 @@ def warning(mes):
     print "WARNING - %s" % (mes)
     return
 
+def add_trace_event(name, category, start, end, args):
+    '''
+    Add a complete event to the timeline, when profiling.
+    :param name: name shown in the timeline
+    :param category: category of the event
+    :param start: start time, in seconds since the epoch
+    :param end: end time, in seconds since the epoch
+    :param args: dict of JSON formatted values shown with the event
+    '''
+    if Trace is None:
+        return
+    TraceLock.acquire()
+    try:
+        thread_name = threading.currentThread().getName()
+        if thread_name not in TraceThreads:
+            TraceThreads[thread_name] = len(TraceThreads)
+        Trace.append({'name':json_quote(name), 'cat':json_quote(category), 'ph':'"X"', 'pid':os.getpid(), 'tid':TraceThreads[thread_name],
+                      'ts':int(start * 1000000), 'dur':int((end - start) * 1000000), 'args':doc_to_json(args)})
+    finally:
+        TraceLock.release()
+
+def bson_value_size(value_type, data, pos):
+    '''
+    Return the size of a BSON encoded value, from its type and its data.
+    :param value_type: BSON type of the value
+    :param data: string holding the value
+    :param pos: position of the value in 'data'
+    '''
+    if value_type in BSON_FIXED_SIZES:
+        return BSON_FIXED_SIZES[value_type]
+    if value_type in (0x02, 0x0D, 0x0E):
+        return 4 + struct.unpack("<i", data[pos:pos + 4])[0]
+    if value_type in (0x03, 0x04, 0x0F):
+        return struct.unpack("<i", data[pos:pos + 4])[0]
+    if value_type == 0x05:
+        return 5 + struct.unpack("<i", data[pos:pos + 4])[0]
+    if value_type == 0x0B:
+        return data.index("\x00", data.index("\x00", pos) + 1) + 1 - pos
+    if value_type == 0x0C:
+        return 16 + struct.unpack("<i", data[pos:pos + 4])[0]
+    raise Exception("Unknown BSON type: %d" % (value_type))
+
+def count_docs(filepath):
+    '''
+    Return the number of documents in a dumped or exported collection.
+    A ".bson" file is walked using the length at the start of each document,
+    a JSON file from the "_collections" dir has one document per line, and
+    a collection encoded by 'encode_timeseries' has the count in the header
+    of each block. Any other file, like the metadata, counts as 0.
+    :param filepath: file to count the documents of
+    '''
+    docs = 0
+    if filepath.endswith(".bson"):
+        size = os.path.getsize(filepath)
+        bson_file = open(filepath, 'rb')
+        pos = 0
+        while pos < size:
+            bson_file.seek(pos)
+            header = bson_file.read(4)
+            doc_len = 0
+            if len(header) == 4:
+                doc_len = struct.unpack("<i", header)[0]
+            # A bad length would loop for ever, or count past the end
+            if doc_len < 5 or pos + doc_len > size:
+                bson_file.close()
+                raise Exception("Truncated or corrupted BSON file: %s" % (filepath))
+            pos += doc_len
+            docs += 1
+        bson_file.close()
+    elif filepath.endswith(TIMESERIES_EXT):
+        encoded_file = open(filepath, 'rb')
+        encoded_file.seek(len(TIMESERIES_MAGIC))
+        header_len = struct.calcsize("<II")
+        while True:
+            header = encoded_file.read(header_len)
+            if not header:
+                break
+            if len(header) < header_len:
+                encoded_file.close()
+                raise Exception("Truncated encoded collection: %s" % (filepath))
+            (count, data_len) = struct.unpack("<II", header)
+            docs += count
+            encoded_file.seek(data_len, os.SEEK_CUR)
+        encoded_file.close()
+    elif COLLECTIONS_DIR in filepath.split(os.sep):
+        json_file = open(filepath, 'r')
+        for line in json_file:
+            if line.strip():
+                docs += 1
+        json_file.close()
+    return docs
+
+def decode_timeseries(source, bson_path, pool=None, jobs=1):
+    '''
+    Decode a collection encoded by 'encode_timeseries' back to the original
+    ".bson" file, one block at a time.
+    :param source: encoded collection
+    :param bson_path: ".bson" file to write
+    :param pool: optional process pool decoding the blocks
+    :param jobs: number of processes in the pool
+    '''
+    encoded_file = open(source, 'rb')
+    if encoded_file.read(len(TIMESERIES_MAGIC)) != TIMESERIES_MAGIC:
+        encoded_file.close()
+        raise Exception("Not an encoded collection: %s" % (source))
+    def iter_blocks():
+        header_len = struct.calcsize("<II")
+        while True:
+            header = encoded_file.read(header_len)
+            if not header:
+                break
+            data = ""
+            if len(header) == header_len:
+                (count, data_len) = struct.unpack("<II", header)
+                data = encoded_file.read(data_len)
+            if len(header) < header_len or len(data) < data_len:
+                raise Exception("Truncated encoded collection: %s" % (source))
+            yield (count, data)
+    out = open(bson_path, 'wb')
+    try:
+        for docs in map_timeseries_blocks(unpack_timeseries_block, iter_blocks(), pool, jobs):
+            out.write(docs)
+    finally:
+        encoded_file.close()
+        out.close()
+
+def decode_timeseries_block(data, count):
+    '''
+    Decode a block of documents encoded by 'encode_timeseries_block'.
+    :param data: the decompressed block
+    :param count: number of documents in the block
+    '''
+    pos = 0
+    (shape_count,) = struct.unpack("<I", data[pos:pos + 4])
+    pos += 4
+    shapes = []
+    for i in range(shape_count):
+        (field_count,) = struct.unpack("<I", data[pos:pos + 4])
+        pos += 4
+        shape = []
+        for j in range(field_count):
+            key_end = data.index("\x00", pos + 1)
+            shape.append(data[pos:key_end + 1])
+            pos = key_end + 1
+        shapes.append(shape)
+    shape_ids = struct.unpack("<%dI" % (count), unshuffle_bytes(data[pos:pos + 4 * count], 4))
+    pos += 4 * count
+    (column_count,) = struct.unpack("<I", data[pos:pos + 4])
+    pos += 4
+    columns = {}
+    for i in range(column_count):
+        key_end = data.index("\x00", pos + 1)
+        field = data[pos:key_end + 1]
+        (value_count, data_len) = struct.unpack("<II", data[key_end + 1:key_end + 9])
+        pos = key_end + 9
+        columns[field] = decode_timeseries_column(ord(field[0]), data[pos:pos + data_len], value_count)
+        pos += data_len
+    if len(shapes) == 1 and shapes[0] and len(set(shapes[0])) == len(shapes[0]):
+        for field in shapes[0]:
+            if len(columns[field]) != count:
+                raise Exception("Corrupted block of an encoded collection")
+        return join_timeseries_docs(shapes[0], [ columns[field] for field in shapes[0] ])
+    for field in columns:
+        columns[field] = iter(columns[field])
+    docs = []
+    for shape_id in shape_ids:
+        elements = []
+        for field in shapes[shape_id]:
+            elements.append(field)
+            elements.append(columns[field].next())
+        body = "".join(elements)
+        docs.append(struct.pack("<i", len(body) + 5) + body + "\x00")
+    return "".join(docs)
+
+def decode_timeseries_column(value_type, data, count):
+    '''
+    Decode the values of one column encoded by 'encode_timeseries_column'.
+    Return the list of the BSON encoded values.
+    :param value_type: BSON type of the values
+    :param data: the encoded column
+    :param count: number of values in the column
+    '''
+    if value_type in (0x01, 0x09, 0x10, 0x12):
+        # The loops are the hot spot of the import of a compact archive
+        value = 0
+        values = []
+        append = values.append
+        if value_type == 0x10:
+            for delta in struct.unpack("<%dq" % (count), unshuffle_bytes(data, 8)):
+                value += delta
+                append(value)
+            # Split the packed values in C, with a string format per value
+            return list(struct.unpack("4s" * count, struct.pack("<%di" % (count), *values)))
+        if value_type == 0x01:
+            for xor in struct.unpack("<%dQ" % (count), unshuffle_bytes(data, 8)):
+                value ^= xor
+                append(value)
+        else:
+            for delta in struct.unpack("<%dQ" % (count), unshuffle_bytes(data, 8)):
+                value = (value + delta) & INT64_MASK
+                append(value)
+        return list(struct.unpack("8s" * count, struct.pack("<%dQ" % (count), *values)))
+    values = []
+    pos = 0
+    if value_type == 0x02:
+        (word_count,) = struct.unpack("<I", data[:4])
+        pos = 4
+        for i in range(word_count):
+            size = bson_value_size(value_type, data, pos)
+            values.append(data[pos:pos + size])
+            pos += size
+        indexes = struct.unpack("<%dI" % (count), unshuffle_bytes(data[pos:], 4))
+        return map(values.__getitem__, indexes)
+    for i in range(count):
+        size = bson_value_size(value_type, data, pos)
+        values.append(data[pos:pos + size])
+        pos += size
+    return values
+
+def decode_timeseries_dump(directory, jobs):
+    '''
+    Decode all the collections encoded by 'encode_timeseries_dump' back to
+    ".bson" files.
+    The blocks are decoded by a pool of up to 'jobs' processes, one per
+    CPU, as the decoding is pure Python and threads would wait on each other.
+    :param directory: directory where the "dump" dir is located
+    :param jobs: number of processes decoding the blocks
+    '''
+    members = [ member for member in list_dump_files(directory) if member.endswith(TIMESERIES_EXT) ]
+    if not members:
+        return
+    print "Decoding metrics...",
+    jobs = min(jobs, multiprocessing.cpu_count())
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+    try:
+        for member in members:
+            source = os.path.join(directory, *member.split('/'))
+            decode_timeseries(source, source[:-len(TIMESERIES_EXT)] + ".bson", pool, jobs)
+            os.remove(source)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    print " done."
+    if Verbose:
+        print "  decoded %d collections" % (len(members))
+
+def extract_archive_member(archive, entry, target_dir):
+    '''
+    Decompress one member of an indexed archive under a target directory,
+    and check its size and SHA1 against the index.
+    :param archive: path of the indexed archive
+    :param entry: index entry of the member, from 'read_archive_index'
+    :param target_dir: directory under which the member path is created,
+        see 'member_target'
+    '''
+    target = member_target(target_dir, entry['path'])
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Another extraction thread may have created it
+            if not os.path.isdir(parent):
+                raise
+    size = 0
+    checksum = new_checksum()
+    out = open(target, 'wb')
+    for data in iter_archive_member(archive, entry):
+        size += len(data)
+        checksum.update(data)
+        out.write(data)
+    out.close()
+    if size != entry['size'] or checksum.hexdigest() != entry['sha1']:
+        raise Exception("Corrupted member in archive %s: %s" % (archive, entry['path']))
+    return target
+
 def find_paths(deps):
     '''
     Find the paths of all MongoDB tools we need to export the DB.
@@ -497,6 +2078,30 @@ def find_paths(deps):
         fatal("aborting...")
     return paths
 
+def get_file_info(directory, member, count=True):
+    '''
+    Return a dict with the 'path', 'size', 'docs' and 'sha1' of a file of
+    the "dump" tree, as stored in the manifest.
+    :param directory: directory where the "dump" dir is located
+    :param member: path of the file relative to 'directory', with '/'
+    :param count: if False, 'docs' is None and the documents are not walked
+    '''
+    filepath = os.path.join(directory, *member.split('/'))
+    size = 0
+    checksum = new_checksum()
+    in_file = open(filepath, 'rb')
+    while True:
+        data = in_file.read(IO_BUFSIZE)
+        if not data:
+            break
+        size += len(data)
+        checksum.update(data)
+    in_file.close()
+    docs = None
+    if count:
+        docs = count_docs(filepath)
+    return {'path':member, 'size':size, 'docs':docs, 'sha1':checksum.hexdigest()}
+
 def get_host(hostname):
     '''
     Utility function to look into your local hosts file to see
@@ -512,6 +2117,299 @@ def get_host(hostname):
                 break    
     return hostname
 
+def is_indexed_archive(filepath):
+    '''
+    Return True if the file was created with the 'indexed' archive format.
+    :param filepath: file to check
+    '''
+    archive_file = open(filepath, 'rb')
+    magic = archive_file.read(len(ARCHIVE_MAGIC))
+    archive_file.close()
+    return magic == ARCHIVE_MAGIC
+
+def iter_archive_member(archive, entry):
+    '''
+    Generator returning the decompressed data of one archive member, by
+    blocks, reading only the compressed bytes of that member.
+    :param archive: path of the indexed archive
+    :param entry: index entry of the member, from 'read_archive_index'
+    '''
+    decompressor = zlib.decompressobj()
+    archive_file = open(archive, 'rb')
+    archive_file.seek(entry['offset'])
+    remaining = entry['csize']
+    while remaining > 0:
+        data = archive_file.read(min(remaining, IO_BUFSIZE))
+        if not data:
+            archive_file.close()
+            raise Exception("Truncated archive %s: %s" % (archive, entry['path']))
+        remaining -= len(data)
+        yield decompressor.decompress(data)
+    archive_file.close()
+    yield decompressor.flush()
+
+def iter_bson_docs(filepath):
+    '''
+    Generator returning the documents of a ".bson" file, one at a time.
+    :param filepath: ".bson" file to read
+    '''
+    bson_file = open(filepath, 'rb')
+    while True:
+        header = bson_file.read(4)
+        if not header:
+            break
+        doc = ""
+        if len(header) == 4:
+            doc_len = struct.unpack("<i", header)[0]
+            doc = header + bson_file.read(doc_len - 4)
+        if len(doc) < 5 or len(doc) != doc_len:
+            bson_file.close()
+            raise Exception("Truncated BSON file: %s" % (filepath))
+        yield doc
+    bson_file.close()
+
+def iter_bson_elements(doc):
+    '''
+    Generator returning the top level elements of a BSON document, as
+    tuples of (type, key, BSON encoded value).
+    :param doc: the BSON document
+    '''
+    pos = 4
+    end = len(doc) - 1
+    while pos < end:
+        value_type = ord(doc[pos])
+        key_end = doc.index("\x00", pos + 1)
+        size = bson_value_size(value_type, doc, key_end + 1)
+        yield (value_type, doc[pos + 1:key_end], doc[key_end + 1:key_end + 1 + size])
+        pos = key_end + 1 + size
+    if pos != end or doc[end] != "\x00":
+        raise Exception("Malformed BSON document")
+
+def join_timeseries_docs(shape, columns):
+    '''
+    Return the BSON documents of a block with a single shape, joined from
+    the values of their columns without a loop in Python.
+    :param shape: the (type, key) prefixes of the elements, as encoded
+    :param columns: the BSON encoded values of each element of the shape
+    '''
+    parts = []
+    for (field, values) in zip(shape, columns):
+        parts.append(itertools.repeat(field))
+        parts.append(values)
+    bodies = map("".join, itertools.izip(*parts))
+    sizes = map(len, bodies)
+    if min(sizes) == max(sizes):
+        headers = itertools.repeat(INT32.pack(sizes[0] + 5))
+    else:
+        headers = map(INT32.pack, map((5).__add__, sizes))
+    return "".join(itertools.chain.from_iterable(itertools.izip(headers, bodies, itertools.repeat("\x00"))))
+
+def json_quote(value):
+    '''
+    Return a string as a quoted JSON string.
+    :param value: string to quote
+    '''
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    value = re.sub(r'[\x00-\x1f]', lambda m: '\\u%04x' % (ord(m.group(0))), value)
+    return '"%s"' % (value)
+
+def link_spool(dump_dir, spool_dump_dir, name):
+    '''
+    Create a dir in the "dump" dir of a spool, usually on another disk, and
+    link it under the same name in the main "dump" dir, so the data looks
+    like a single tree to the other functions.
+    :param dump_dir: the main "dump" dir
+    :param spool_dump_dir: the "dump" dir of the spool
+    :param name: name of the dir, the name of a DB
+    '''
+    target = os.path.abspath(os.path.join(spool_dump_dir, name))
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    if not os.path.isdir(dump_dir):
+        os.makedirs(dump_dir)
+    os.symlink(target, os.path.join(dump_dir, name))
+
+def list_dump_files(directory):
+    '''
+    Return the sorted paths, relative to 'directory', of all files in the
+    "dump" tree. The paths use '/' so they can be stored in an archive.
+    :param directory: directory where the "dump" dir is located
+    '''
+    files = []
+    prefix = os.path.join(directory, "")
+    for (root, dirs, names) in os.walk(os.path.join(directory, DUMPDIR), followlinks=True):
+        rel_root = root[len(prefix):]
+        for name in names:
+            files.append("/".join(rel_root.split(os.sep) + [name]))
+    files.sort()
+    return files
+
+def map_timeseries_blocks(func, blocks, pool, jobs):
+    '''
+    Generator returning func(block) for each block, in order. With a
+    process pool, at most twice 'jobs' blocks are sent to it at once, so a
+    large collection is not read in memory.
+    :param func: module level function taking one block
+    :param blocks: iterator on the blocks
+    :param pool: process pool, or None to call 'func' here
+    :param jobs: number of processes in the pool
+    '''
+    if pool is None:
+        for block in blocks:
+            yield func(block)
+        return
+    pending = []
+    for block in blocks:
+        pending.append(pool.apply_async(func, (block,)))
+        if len(pending) > 2 * jobs:
+            yield pending.pop(0).get()
+    for result in pending:
+        yield result.get()
+
+def member_namespace(member):
+    '''
+    Return the (db, collection) of a dumped ".bson" file or of an exported
+    collection, or None for any other file of the "dump" tree.
+    :param member: path of the file, like 'dump/mmsdb/data.hosts.bson'
+    '''
+    parts = member.split('/')
+    if len(parts) == 3 and parts[2].endswith(".bson"):
+        return (parts[1], parts[2][:-len(".bson")])
+    if len(parts) == 4 and parts[1] == COLLECTIONS_DIR:
+        return (parts[2], parts[3])
+    return None
+
+def member_target(target_dir, member):
+    '''
+    Return the path of an archive, recipe or pack member under a target
+    directory. The member paths come from the data, so the ones that are
+    absolute, or that escape the target directory, are rejected.
+    :param target_dir: directory under which the member path is created
+    :param member: path of the member, like 'dump/mmsdb/data.hosts.bson'
+    '''
+    target = os.path.join(target_dir, *member.split('/'))
+    root = os.path.abspath(target_dir)
+    if os.path.isabs(member) or not os.path.abspath(target).startswith(root + os.sep):
+        raise Exception("Unsafe path outside of %s: %s" % (target_dir, member))
+    return target
+
+def parallel_map(func, items, jobs):
+    '''
+    Call 'func' on each item with up to 'jobs' threads, and return the
+    results in the order of 'items'.
+    The first failure in a worker, including a 'fatal', is raised again
+    in the caller once all workers are done.
+    :param func: function taking one item
+    :param items: items to process
+    :param jobs: maximum number of threads
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    if jobs <= 1 or len(items) <= 1:
+        for i in range(len(items)):
+            results[i] = func(items[i])
+        return results
+    failures = []
+    lock = threading.Lock()
+    next_item = [0]
+    def worker():
+        while not failures:
+            lock.acquire()
+            try:
+                i = next_item[0]
+                next_item[0] += 1
+            finally:
+                lock.release()
+            if i >= len(items):
+                return
+            try:
+                results[i] = func(items[i])
+            except:
+                failures.append(sys.exc_info())
+    threads = []
+    for i in range(min(jobs, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if failures:
+        (exc_type, exc_value, exc_tb) = failures[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+def read_archive_index(archive):
+    '''
+    Read the table of contents of an indexed archive.
+    Return a list of dicts with the keys: 'path', 'offset', 'csize', 'size',
+    'docs' and 'sha1'.
+    :param archive: path of the indexed archive
+    '''
+    trailer_len = struct.calcsize(">QQ") + len(ARCHIVE_TRAILER)
+    archive_file = open(archive, 'rb')
+    archive_file.seek(-trailer_len, 2)
+    trailer = archive_file.read(trailer_len)
+    if not trailer.endswith(ARCHIVE_TRAILER):
+        archive_file.close()
+        raise Exception("Missing index in archive, the file may be truncated: %s" % (archive))
+    (index_offset, index_len) = struct.unpack(">QQ", trailer[:-len(ARCHIVE_TRAILER)])
+    archive_file.seek(index_offset)
+    index_data = archive_file.read(index_len)
+    archive_file.close()
+    entries = []
+    for line in index_data.splitlines():
+        (path, offset, csize, size, docs, sha1) = line.split("\t")
+        entries.append({'path':path, 'offset':int(offset), 'csize':int(csize), 'size':int(size), 'docs':int(docs), 'sha1':sha1})
+    return entries
+
+def read_archive_member(archive, entry):
+    '''
+    Return the content of a small archive member, like the MMS version file.
+    :param archive: path of the indexed archive
+    :param entry: index entry of the member, from 'read_archive_index'
+    '''
+    return "".join(iter_archive_member(archive, entry))
+
+def read_manifest(directory):
+    '''
+    Read the manifest written by 'write_manifest'.
+    Return a list of dicts with the keys 'path', 'size', 'docs' and 'sha1',
+    or None if the data was exported without a manifest.
+    :param directory: directory where the "dump" dir is located
+    '''
+    manifest_path = os.path.join(directory, DUMPDIR, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    entries = []
+    manifest_file = open(manifest_path, 'r')
+    for line in manifest_file:
+        (path, size, docs, sha1) = line.rstrip("\n").split("\t")
+        entries.append({'path':path, 'size':int(size), 'docs':int(docs), 'sha1':sha1})
+    manifest_file.close()
+    return entries
+
+def reap_process(process, block=True):
+    '''
+    Wait for a process started with 'subprocess', and return its wait status
+    and resource usage, or None if 'block' is False and it is still running.
+    The resource usage is None if the process was already reaped.
+    :param process: 'subprocess.Popen' object
+    :param block: wait for the process to end
+    '''
+    if process.returncode is not None:
+        return (process.returncode, None)
+    flags = 0
+    if not block:
+        flags = os.WNOHANG
+    (pid, status, rusage) = os.wait4(process.pid, flags)
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return (status, rusage)
+
 def replace_string(filename, search_exp, replace_exp):
     '''
     Utility to replace a string in a file.
@@ -519,10 +2417,16 @@ def replace_string(filename, search_exp, replace_exp):
     :param search_exp: string to be replaced
     :param replace_exp: replacement string
     '''
-    for line in fileinput.input(filename, inplace=1):
+    # Not 'fileinput', which redirects 'sys.stdout' for all the threads
+    in_file = open(filename, 'r')
+    out_file = open(filename + ".tmp", 'w')
+    for line in in_file:
         if search_exp in line:
             line = line.replace(search_exp, replace_exp)
-        sys.stdout.write(line)
+        out_file.write(line)
+    out_file.close()
+    in_file.close()
+    os.rename(filename + ".tmp", filename)
 
 def run_cmd(cmd, array=True, abort=False, norun=False):
     '''
@@ -542,7 +2446,14 @@ def run_cmd(cmd, array=True, abort=False, norun=False):
     else:
         if Verbose:
             print "Running CMD: %s" % (cmd)
-        (status, out) = commands.getstatusoutput(cmd)
+        start = time.time()
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = process.stdout.read()
+        process.stdout.close()
+        (status, rusage) = reap_process(process)
+        trace_cmd(cmd, start, process.returncode, rusage, len(out))
+        if out.endswith('\n'):
+            out = out[:-1]
         if status != 0:
             if abort:
                 raise Exception("ERROR in running - %s\n%s" % (cmd, out))
@@ -550,6 +2461,138 @@ def run_cmd(cmd, array=True, abort=False, norun=False):
             return status, out.split('\n')
     return status, out
 
+def shuffle_bytes(data, width):
+    '''
+    Group the bytes of same weight of fixed size numbers together, as
+    their high bytes change little from one number to the next.
+    :param data: the packed numbers
+    :param width: size of each number in bytes
+    '''
+    return "".join([ data[i::width] for i in range(width) ])
+
+def start_local_mongod(mongod, dbpath, logpath):
+    '''
+    Start a 'mongod' on a data directory, only reachable from this host on a
+    free port, to work on data files. Return its port.
+    :param mongod: path to 'mongod'
+    :param dbpath: data directory to use
+    :param logpath: log file of the 'mongod'
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCALHOST, 0))
+    port = str(sock.getsockname()[1])
+    sock.close()
+    cmd = "%s --dbpath %s --port %s --bind_ip %s --fork --logpath %s" % (mongod, dbpath, port, LOCALHOST, logpath)
+    run_cmd(cmd, abort=True, norun=Norun)
+    return port
+
+def start_profiling(prefix):
+    '''
+    Profile the tool until it exits, then write:
+      - PREFIX.pstats, the Python profile of the main thread and of the
+        threads it started, like the workers of 'parallel_map', to read
+        with the 'pstats' module
+      - PREFIX.trace.json, a timeline of the tool and of all the commands
+        it ran, in the Trace Event format of chrome://tracing and Perfetto
+    Each thread has its own profiler, started by the hook set with
+    'threading.setprofile', and the profiles are merged at exit. The
+    processes of the pools of the columnar codec are not profiled.
+    :param prefix: path prefix of the files to write
+    '''
+    global Trace
+    Trace = []
+    start = time.time()
+    profiler = None
+    thread_profilers = []
+    try:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        def profile_thread(frame, event, arg):
+            # Called once in each new thread, the profiler then replaces the hook
+            thread_profiler = cProfile.Profile()
+            thread_profilers.append(thread_profiler)
+            thread_profiler.enable()
+        threading.setprofile(profile_thread)
+        profiler.enable()
+    except ImportError:
+        warning("No 'cProfile' module, only the commands will be traced")
+    def stop_profiling():
+        end = time.time()
+        if profiler is not None:
+            profiler.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(profiler)
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)
+            stats.dump_stats(prefix + PROFILE_EXT)
+        add_trace_event(os.path.basename(sys.argv[0]), "tool", start, end, {'argv':json_quote(" ".join(sys.argv[1:]))})
+        write_trace(prefix + TRACE_EXT)
+        print "Profile written to %s%s and %s%s" % (prefix, PROFILE_EXT, prefix, TRACE_EXT)
+    atexit.register(stop_profiling)
+
+def stop_local_mongod(mongod, dbpath):
+    '''
+    Cleanly stop a 'mongod' started with 'start_local_mongod'.
+    :param mongod: path to 'mongod'
+    :param dbpath: data directory of the 'mongod'
+    '''
+    run_cmd("%s --dbpath %s --shutdown" % (mongod, dbpath), abort=True, norun=Norun)
+
+def trace_cmd(cmd, start, exit_code, rusage, output_size):
+    '''
+    Add a command that just ended to the timeline, when profiling.
+    The passwords are masked.
+    :param cmd: command line
+    :param start: start time, in seconds since the epoch
+    :param exit_code: exit code of the command, negative if killed by a signal
+    :param rusage: resource usage of the command, may be None
+    :param output_size: bytes the command wrote on its output
+    '''
+    if Trace is None:
+        return
+    args = {'exit_code':exit_code, 'output_bytes':output_size}
+    if rusage is not None:
+        args['read_bytes'] = rusage.ru_inblock * BLOCK_SIZE
+        args['written_bytes'] = rusage.ru_oublock * BLOCK_SIZE
+        args['cpu_seconds'] = "%.3f" % (rusage.ru_utime + rusage.ru_stime)
+    add_trace_event(re.sub(r'--password\s+\S+', '--password ***', cmd), "command", start, time.time(), args)
+
+def unpack_timeseries_block(block):
+    '''
+    Return the documents of a block written by 'pack_timeseries_block'.
+    Run in the processes of the pool of 'decode_timeseries_dump'.
+    :param block: tuple of the count of documents and the compressed block
+    '''
+    (count, data) = block
+    return decode_timeseries_block(zlib.decompress(data), count)
+
+def unshuffle_bytes(data, width):
+    '''
+    Put back the bytes grouped by 'shuffle_bytes'.
+    :param data: the shuffled numbers
+    :param width: size of each number in bytes
+    '''
+    count = len(data) / width
+    result = bytearray(len(data))
+    for i in range(width):
+        result[i::width] = data[i * count:(i + 1) * count]
+    return str(result)
+
+def write_trace(filename):
+    '''
+    Write the timeline in the Trace Event format.
+    :param filename: file to write
+    '''
+    TraceLock.acquire()
+    try:
+        events = [ doc_to_json(event) for event in Trace ]
+    finally:
+        TraceLock.release()
+    trace_file = open(filename, 'w')
+    trace_file.write('{ "displayTimeUnit":"ms", "traceEvents":[\n%s\n] }\n' % (",\n".join(events)))
+    trace_file.close()
+
 # Utility classes
 class flushfile(object):
     '''
@@ -562,6 +2605,55 @@ class flushfile(object):
         self.f.write(x)
         self.f.flush()
 
+class DiskBudget(object):
+    '''
+    Space budget of an output directory shared by concurrent exports.
+    An export reserves the space it needs before starting, and waits while
+    the free space, minus the space the running exports still need, is too
+    small. What an export has already written is taken from the free space,
+    so only the rest of its reservation is counted.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.reservations = {}
+        self.condition = threading.Condition()
+
+    def get_outstanding(self):
+        '''
+        Return the space in MB the running exports still need: the space
+        each one reserved, minus what it wrote in its directory since.
+        '''
+        outstanding = 0
+        for (directory, (space, start_size)) in self.reservations.items():
+            written = (get_dir_size(directory) - start_size) / (1024 * 1024)
+            outstanding += max(0, space - written)
+        return outstanding
+
+    def release(self, directory):
+        self.condition.acquire()
+        try:
+            del self.reservations[directory]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def reserve(self, space, name, directory):
+        self.condition.acquire()
+        try:
+            while True:
+                space_avail = get_avail_space(self.directory) - self.get_outstanding() - MIN_DISK_SPACE
+                if space <= space_avail:
+                    break
+                if not self.reservations:
+                    fatal("Export of %s needs ~%d MBytes free, there is only %d MBytes available on disk" % (name, space, space_avail))
+                if Verbose:
+                    print "Waiting for disk space to export %s" % (name)
+                # The exports may use less than they reserved, check again later
+                self.condition.wait(PROBE_INTERVAL)
+            self.reservations[directory] = (space, get_dir_size(directory))
+        finally:
+            self.condition.release()
+
 class AuthException(Exception):
     pass
 
@@ -8,9 +8,13 @@ Created in January 2014
 Script to restore an MMS instance.
   - it connects to the MMS host to receive the data
   - explodes the .gzip file
+  - decodes the metrics encoded by columns back to BSON
   - clean the data
     - remove the MMS configuration, so we don't overwrite the target
   - restore the data with 'mongorestore' and 'mongoimport'
+    - when the data has a manifest, one collection at a time by priority, so the
+      viewer is usable before the older metrics are restored
+  - or, for a physical export, replace the data files of a stopped viewer instance
   - creates an entry about that restore, so we get the a trace of the import, the time, ...
   
 Instructions for using the tools are at:
@@ -32,6 +36,8 @@ Implementation details:
 '''
 
 import bson
+import bson.son
+import datetime
 import optparse
 import os
 import pymongo
@@ -42,6 +48,7 @@ import sys
 import tarfile
 import time
 import traceback
+import zlib
 
 ROOTDIR = os.path.dirname(__file__)
 sys.path.insert(0, ROOTDIR)
@@ -51,10 +58,35 @@ TOOL = "mongo_mms_import"
 VERSION = "0.1.0"
 
 DEPS = [ "mongo", "mongoimport", "mongorestore" ]
+PHYSICAL_DEPS = [ "mongod", "mongodump" ]
 PID = os.getpid()
 
+IMPORTER_LOADS = ("importer", "loads")
+UPSERT_BATCH = 1000
+
+# Restore order, see 'get_restore_priority'
+PRIORITY_CONFIG = 0
+PRIORITY_EXPORTED = 1
+PRIORITY_RECENT = 2
+PRIORITY_HISTORY = 3
+# Collections of the metrics DBs holding the recent samples, by MMS version
+# from 'get_mms_version', the versions not listed use the None entry. They
+# are checked against the collections imported, see 'get_recent_metrics'
+RECENT_METRICS = {
+    None: [ r"minute", r"latest", r"current" ],
+}
+VIEWER_CONFIG_DIR = "viewer_config"
+VIEWER_DBS = [ "admin", mongo_mms_export.DB_CLOUDCONF ]
+
 COLLECTIONS_TO_IMPORT = [ ("mmsdbconfig", "config.customers"), mongo_mms_export.IMPORTER_LOGS ] # IMPROVE, find all collections by looking at dir, except ("cloudconf", "app.migrations")
 
+try:
+    from bson.codec_options import CodecOptions
+    DECODE_OPTIONS = { "codec_options":CodecOptions(document_class=bson.son.SON) }
+except ImportError:
+    # pymongo 2.x
+    DECODE_OPTIONS = { "as_class":bson.son.SON }
+
 Verbose = False
 
 def get_opts():
@@ -64,16 +96,26 @@ def get_opts():
     parser = optparse.OptionParser(version="%prog " + VERSION)
     group_general = optparse.OptionGroup(parser, "General options")
     parser.add_option_group(group_general)
+    group_general.add_option("--background", dest="background", type="string", default="", help="once the viewer is ready, restore the older metrics in a background process appending its output to LOG, and return. Needs a manifest, and can't be used with '--dbpath'", metavar="LOG")
     group_general.add_option("-d", "--data", dest="data", type="string", default="", help="name of the .gzip file or directory to import", metavar="FILE")
+    group_general.add_option("--dbpath", dest="dbpath", type="string", default="", help="the data is a physical export, from the exporter's '--dbpath'. Replace the data files of the stopped MMS viewer instance in DIR. The viewer keeps its users, MMS config and the collections the exporter strips, but loses its previous imports", metavar="DIR")
+    group_general.add_option("-j", "--jobs", dest="jobs", type="int", default=mongo_mms_export.DEFAULT_JOBS, help="number of files to extract, verify or count, or processes decoding compact metrics, in parallel", metavar="JOBS")
+    group_general.add_option("-l", "--list", dest="list", action="store_true", default=False, help="list the contents of an indexed archive given with '--data', and exit")
+    group_general.add_option("-o", "--only", dest="only", action="append", default=[], help="only extract and restore this DB, or DB.COLLECTION, from an indexed archive. Can be repeated", metavar="NAME")
+    group_general.add_option("-f", "--force", dest="force", action="store_true", default=False, help="restore all the collections, even the ones already loaded by a previous import of the same data")
     group_general.add_option("--host", dest="host", type="string", default='localhost', help="host name of the MMS server", metavar="HOST")
     group_general.add_option("-p", "--port", dest="port", type="string", default='27017', help="port of the MMS server", metavar="PORT")
     group_general.add_option("--password", dest="password", type="string", default='', help="password for a secured MMS DB", metavar="PASSWORD")
+    group_general.add_option("--profile", dest="profile", type="string", default="", help="profile the import, and write PREFIX%s and PREFIX%s" % (mongo_mms_export.PROFILE_EXT, mongo_mms_export.TRACE_EXT), metavar="PREFIX")
+    group_general.add_option("--spool", dest="spool", action="append", default=[], help="another temporary dir, usually on another disk, to spread the extracted DBs over by free space, so they are restored from all the disks at once. Needs an indexed archive or '--store'. Can be repeated", metavar="DIR")
+    group_general.add_option("--store", dest="store", type="string", default="", help="rebuild the data from the deduplicating store in DIR. '--data' is then a pack from the exporter, added to the store first, or the name of a recipe already in the store", metavar="DIR")
     group_general.add_option("-t", "--tmpdir", dest="tmpdir", type="string", default=".", help="temporary dir to use for the restore", metavar="DIR")
-    group_general.add_option("-u", "--upsert", dest="upsert", action="store_true", default=False, help="upsert/update the data that already exists")
+    group_general.add_option("-u", "--upsert", dest="upsert", action="store_true", default=False, help="upsert/update the data that already exists, the collections changed since their last import are always upserted")
     group_general.add_option("--username", dest="username", type="string", default='', help="username for a secured MMS DB", metavar="USERNAME")
     group_general.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="show more output")
     group_security = optparse.OptionGroup(parser, "Security options")
     parser.add_option_group(group_security)
+    group_security.add_option("--noverify", dest="noverify", action="store_true", default=False, help="don't verify the data against its manifest before restoring, nor the counts after")
     group_security.add_option("-n", "--norun", dest="norun", action="store_true", default=False, help="don't run, just show what would be run")
     (options, args) = parser.parse_args()
     return options, args
@@ -90,6 +132,37 @@ def add_data(directory, groups):
     add_fields = ', "import_host":"%s", "import_ts":{"$date":%d}, "groups":%s' % (socket.gethostname(), now, groups_string)
     mongo_mms_export.replace_string(col_filepath, "}\n", add_fields + "}\n")
     
+def check_restored_counts(auth_dict, host, port, entries, jobs):
+    '''
+    Check that the target instance has at least as many documents as the
+    manifest for each restored collection. The counts are queried in
+    parallel. Return the number of collections with missing documents.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param entries: manifest entries of the restored files
+    :param jobs: number of count queries to run in parallel
+    '''
+    print "Checking the restored counts...",
+    expected = []
+    for entry in entries:
+        namespace = mongo_mms_export.member_namespace(entry['path'])
+        if namespace is None:
+            continue
+        if entry['path'].split("/")[1] == mongo_mms_export.COLLECTIONS_DIR and namespace not in COLLECTIONS_TO_IMPORT:
+            continue
+        expected.append((namespace, entry['docs']))
+    client = get_client(auth_dict, host, port)
+    counts = mongo_mms_export.parallel_map(lambda one_expected: client[one_expected[0][0]][one_expected[0][1]].count(), expected, jobs)
+    print " done."
+    missing = 0
+    for ((namespace, docs), count) in zip(expected, counts):
+        if count < docs:
+            mongo_mms_export.error("Collection %s.%s has %d documents, %d were exported" % (namespace[0], namespace[1], count, docs))
+            missing += 1
+        elif Verbose:
+            print "  %s.%s: %d documents" % (namespace[0], namespace[1], count)
+    return missing
+
 def clean_data(directory):
     '''
     Remove the MMS config data
@@ -99,18 +172,119 @@ def clean_data(directory):
     if os.path.exists(col_dir):
         shutil.rmtree(col_dir)
 
+def detach(log_file):
+    '''
+    Fork, and let the parent exit once the child is started, so the caller
+    goes on in the background. The child leaves the session of the
+    terminal, and appends its output to the log file.
+    :param log_file: file the output of the child is appended to
+    '''
+    log = open(log_file, "a")
+    pid = os.fork()
+    if pid:
+        print "Going on in the background, pid %d, see: %s" % (pid, log_file)
+        # Skip the exit handlers, the child runs them, like the profiling
+        os._exit(0)
+    os.setsid()
+    null = open(os.devnull, "r")
+    os.dup2(null.fileno(), sys.stdin.fileno())
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    null.close()
+    log.close()
+    print "%s: background restore started, pid %d" % (time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid())
+
+def explode_archive(archive, target_dir, only, jobs, spools):
+    '''
+    Extract an indexed archive to a target directory, and return the index
+    entries of the extracted members, whose size and SHA1 were checked.
+    Only the members selected with '--only' are decompressed, and they are
+    extracted in parallel.
+    :param archive: indexed archive to extract
+    :param target_dir: target location for the files
+    :param only: list of DB or DB.COLLECTION names to extract, all if empty
+    :param jobs: number of members to extract in parallel
+    :param spools: list of the spool dirs to spread the DBs over
+    '''
+    entries = []
+    db_sizes = {}
+    for entry in mongo_mms_export.read_archive_index(archive):
+        if is_member_selected(entry['path'], only):
+            entries.append(entry)
+            parts = entry['path'].split("/")
+            if len(parts) == 3 and parts[1] != mongo_mms_export.COLLECTIONS_DIR:
+                db_sizes[parts[1]] = db_sizes.get(parts[1], 0) + entry['size']
+    if spools:
+        spread_over_spools(target_dir, spools, db_sizes)
+    print "Extracting archive...",
+    mongo_mms_export.parallel_map(lambda entry: mongo_mms_export.extract_archive_member(archive, entry, target_dir), entries, jobs)
+    print " done."
+    if Verbose:
+        print "  extracted %d files" % (len(entries))
+    return entries
+
 def explode_gzip(gzipfile, target_dir):
     '''
-    Explode the gzip file to a target directory
+    Explode the gzip file to a target directory, after checking that none
+    of its files or links lead outside of it, see 'member_target'
     :param gzipfile: file to explode
     :param target_dir: target location for the files
     '''
     print "Exploding gzip file...",
     tar = tarfile.open(gzipfile, "r:gz")
+    try:
+        for member in tar.getmembers():
+            mongo_mms_export.member_target(target_dir, member.name)
+            if member.issym():
+                mongo_mms_export.member_target(target_dir, os.path.dirname(member.name) + "/" + member.linkname)
+            elif member.islnk():
+                mongo_mms_export.member_target(target_dir, member.linkname)
+    except Exception:
+        tar.close()
+        raise
     tar.extractall(path=target_dir)    
     tar.close()
     print " done."    
     
+def get_archive_mms_version(archive):
+    '''
+    Get the MMS version of the data in an indexed archive, without
+    extracting the archive.
+    :param archive: indexed archive to import
+    '''
+    version = None
+    version_member = "/".join((mongo_mms_export.DUMPDIR, mongo_mms_export.MMS_VERSION_FILE))
+    for entry in mongo_mms_export.read_archive_index(archive):
+        if entry['path'] == version_member:
+            version = mongo_mms_export.read_archive_member(archive, entry).strip()
+            break
+    return version
+
+def get_case_id(dump_dir):
+    '''
+    Return the case ID the exporter wrote in the importer logs, see
+    'write_import_data', or "" if it has none.
+    :param dump_dir: the "dump" dir
+    '''
+    logs_file = open(os.path.join(dump_dir, mongo_mms_export.COLLECTIONS_DIR, mongo_mms_export.IMPORTER_LOGS[0], mongo_mms_export.IMPORTER_LOGS[1]))
+    m = re.search(r'"case_id"\s*:\s*"?([^",}\s]*)', logs_file.read())
+    logs_file.close()
+    if m:
+        return m.group(1)
+    return ""
+
+def get_client(auth_dict, host, port):
+    '''
+    Return a client connected, and authenticated if needed, to the target
+    MMS instance.
+    :param host: of the target MMS instance.
+    :param port: of the target MMS instance.
+    '''
+    client = pymongo.mongo_client.MongoClient(host=host, port=int(port))
+    if auth_dict is not None:
+        client['admin'].authenticate(auth_dict['username'], auth_dict['password'], source=auth_dict['auth_database'])
+    return client
+
 def get_data_mms_version(directory):
     '''
     Get the MMS version of the data to import
@@ -124,6 +298,75 @@ def get_data_mms_version(directory):
         version_file.close()
     return version
         
+def get_entries_to_load(auth_dict, host, port, entries, force, case_id):
+    '''
+    Return the manifest entries of the files 'restore_changed_collections'
+    will load: the collections not loaded yet, see 'is_entry_loaded', and
+    the files that are not collections, like the metadata.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param entries: manifest entries of the files to restore
+    :param force: load all the collections, even the ones already loaded
+    :param case_id: case the data belongs to, from 'get_case_id'
+    '''
+    others = []
+    collections = []
+    for entry in entries:
+        namespace = mongo_mms_export.member_namespace(entry['path'])
+        if namespace is None:
+            others.append(entry)
+            continue
+        is_exported = entry['path'].split("/")[1] == mongo_mms_export.COLLECTIONS_DIR
+        if not is_exported or namespace in COLLECTIONS_TO_IMPORT:
+            collections.append(entry)
+    if force:
+        return others + collections
+    client = get_client(auth_dict, host, port)
+    loads = client[IMPORTER_LOADS[0]][IMPORTER_LOADS[1]]
+    return others + [ entry for entry in collections if not is_entry_loaded(loads, entry, case_id) ]
+
+def get_extract_dir(tmpdir):
+    '''
+    Return the temporary directory to extract the data to, after removing
+    the one left over by a previous run with the same PID.
+    :param tmpdir: temporary dir to use for the restore
+    '''
+    extract_dir = os.path.join(tmpdir, str(PID))
+    if os.path.exists(extract_dir):
+        mongo_mms_export.warning("Remove previously left over temp dir: %s" % (extract_dir))
+        shutil.rmtree(extract_dir)
+    return extract_dir
+
+def get_load_id(entry, case_id):
+    '''
+    Return the '_id' of the record of the load of a collection in
+    IMPORTER_LOADS. Several cases are loaded in the same collections, so
+    the loads are recorded by case.
+    :param entry: manifest entry of the collection
+    :param case_id: case the data belongs to
+    '''
+    (db, coll) = mongo_mms_export.member_namespace(entry['path'])
+    return "%s:%s.%s:%s" % (case_id, db, coll, entry['sha1'])
+
+def get_manifest_entries(extract_dir, only):
+    '''
+    Return the manifest entries of the files to restore, or None if the
+    data was exported without a manifest.
+    The files the importer rewrites, and the ones not selected with
+    '--only', are left out.
+    :param extract_dir: directory where the "dump" dir is located
+    :param only: list of DB or DB.COLLECTION names to restore, all if empty
+    '''
+    entries = mongo_mms_export.read_manifest(extract_dir)
+    if entries is None:
+        mongo_mms_export.warning("No manifest found, the data can't be verified and will be fully restored")
+        return None
+    selected = []
+    for entry in entries:
+        if is_member_selected(entry['path'], only) and not is_member_rewritten(entry['path']):
+            selected.append(entry)
+    return selected
+
 def get_mms_version(auth_dict, host, port):
     '''
     Get the MMS version of the target instance.
@@ -153,6 +396,406 @@ def get_mms_version(auth_dict, host, port):
         version = "1.1"
     return version
 
+def get_recent_metrics(mms_version, entries):
+    '''
+    Return the patterns of the metrics collections holding the recent
+    samples for a MMS version, from RECENT_METRICS, and warn about the ones
+    that match none of the metrics collections to import: the schema of
+    that version has changed, and the viewer would be reported ready too
+    early.
+    :param mms_version: of the target instance
+    :param entries: manifest entries of the files to restore
+    '''
+    patterns = RECENT_METRICS.get(mms_version, RECENT_METRICS[None])
+    metrics_colls = []
+    for entry in entries:
+        namespace = mongo_mms_export.member_namespace(entry['path'])
+        if namespace is None:
+            continue
+        (db, coll) = namespace
+        for metrics_db in mongo_mms_export.METRICS_DBS:
+            if re.search(metrics_db, db):
+                metrics_colls.append(coll)
+                break
+    if metrics_colls:
+        for pattern in patterns:
+            if not [ coll for coll in metrics_colls if re.search(pattern, coll) ]:
+                mongo_mms_export.warning("No metrics collection matches '%s' of RECENT_METRICS for MMS version %s, check the list against: %s" % (pattern, mms_version, ", ".join(sorted(set(metrics_colls)))))
+    return patterns
+
+def get_restore_priority(entry, recent_metrics):
+    '''
+    Return the priority of a collection in the restore, lower first:
+      - PRIORITY_EXPORTED for the exported collections, like the customers
+      - PRIORITY_RECENT for the metrics DBs, METRICS_DBS, collections that
+        hold recent samples, matching 'recent_metrics'
+      - PRIORITY_HISTORY for the other collections of the metrics DBs
+      - PRIORITY_CONFIG for everything else, like the MMS config
+    :param entry: manifest entry of a dumped or exported collection
+    :param recent_metrics: patterns from 'get_recent_metrics'
+    '''
+    if entry['path'].split("/")[1] == mongo_mms_export.COLLECTIONS_DIR:
+        return PRIORITY_EXPORTED
+    (db, coll) = mongo_mms_export.member_namespace(entry['path'])
+    for metrics_db in mongo_mms_export.METRICS_DBS:
+        if re.search(metrics_db, db):
+            for recent_coll in recent_metrics:
+                if re.search(recent_coll, coll):
+                    return PRIORITY_RECENT
+            return PRIORITY_HISTORY
+    return PRIORITY_CONFIG
+
+def get_viewer_namespaces():
+    '''
+    Return the (db, collection) of the viewer data a logical import keeps,
+    and a physical import must save and restore: the users, the MMS
+    config, and the collections the exporter strips with FILES_TO_REMOVE.
+    The collection is None for a whole DB.
+    '''
+    namespaces = [ (one_db, None) for one_db in VIEWER_DBS ]
+    for one_glob in mongo_mms_export.FILES_TO_REMOVE:
+        (db, name) = one_glob.split("/")
+        if db not in VIEWER_DBS and "*" not in one_glob:
+            namespaces.append((db, name[:-len(".bson")]))
+    return namespaces
+
+def import_collection(mongoimport, auth_string, host, port, json_file, db, coll, upsert):
+    '''
+    Load one collection exported by 'mongoexport' into our target instance.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param json_file: file with one JSON document per line
+    :param db: target DB
+    :param coll: target collection
+    :param upsert: upsert/overwrite existing data
+    '''
+    cmd = "%s %s --host %s --port %s -d %s -c %s --file %s" % (mongoimport, auth_string, host, port, db, coll, json_file)
+    if upsert:
+        cmd = cmd + " --upsert"
+    mongo_mms_export.run_cmd(cmd, abort=True)
+
+def is_entry_loaded(loads, entry, case_id):
+    '''
+    Return True if a collection was loaded by a previous run: the load of
+    the same checksum for the same case was recorded as complete, which is
+    only done once the load succeeded. The count of documents in the target
+    tells nothing, as several cases share the same collections.
+    :param loads: the IMPORTER_LOADS collection
+    :param entry: manifest entry of the collection
+    :param case_id: case the data belongs to
+    '''
+    previous = loads.find_one({"_id":get_load_id(entry, case_id)})
+    return bool(previous and previous.get("complete"))
+
+def is_member_rewritten(path):
+    '''
+    Return True for the files the importer removes or modifies before the
+    restore, see 'clean_data' and 'add_data'. They can't be verified on a
+    directory which was already imported.
+    :param path: path of the file in the "dump" tree
+    '''
+    parts = path.split("/")
+    if len(parts) >= 3 and parts[1] == mongo_mms_export.DB_CLOUDCONF:
+        return True
+    return mongo_mms_export.member_namespace(path) == mongo_mms_export.IMPORTER_LOGS
+
+def is_member_selected(path, only):
+    '''
+    Return True if an archive member belongs to the DBs or collections
+    selected with '--only'.
+    Files that are not under a DB directory, like the MMS version, and the
+    exported collections are always selected.
+    :param path: path of the member in the archive
+    :param only: list of DB or DB.COLLECTION names, all are selected if empty
+    '''
+    parts = path.split("/")
+    if not only or len(parts) != 3 or parts[1] == mongo_mms_export.COLLECTIONS_DIR:
+        return True
+    (db, coll) = (parts[1], parts[2])
+    for suffix in (".metadata.json", ".bson", mongo_mms_export.TIMESERIES_EXT):
+        if coll.endswith(suffix):
+            coll = coll[:-len(suffix)]
+            break
+    return db in only or "%s.%s" % (db, coll) in only
+
+def list_archive(archive):
+    '''
+    Show the table of contents of an indexed archive.
+    :param archive: indexed archive to list
+    '''
+    total_size = 0
+    total_docs = 0
+    for entry in mongo_mms_export.read_archive_index(archive):
+        print "%12d %10d  %s" % (entry['size'], entry['docs'], entry['path'])
+        total_size += entry['size']
+        total_docs += entry['docs']
+    print "%12d %10d  total" % (total_size, total_docs)
+
+def read_chunk(store, checksum):
+    '''
+    Return the data of a chunk of the deduplicating store, after checking
+    its SHA1.
+    :param store: directory of the deduplicating store
+    :param checksum: SHA1 of the chunk
+    '''
+    chunk_path = os.path.join(store, mongo_mms_export.STORE_CHUNKS, checksum[:2], checksum)
+    chunk_file = open(chunk_path, 'rb')
+    chunk = zlib.decompress(chunk_file.read())
+    chunk_file.close()
+    if mongo_mms_export.new_checksum(chunk).hexdigest() != checksum:
+        raise Exception("Corrupted chunk in the store: %s" % (chunk_path))
+    return chunk
+
+def rebuild_dump(store, recipe, target_dir, only, jobs, spools):
+    '''
+    Rebuild the "dump" tree of a recipe from the chunks of the store.
+    Each file is written one chunk at a time, and files are rebuilt in
+    parallel.
+    :param store: directory of the deduplicating store
+    :param recipe: name of the recipe to rebuild
+    :param target_dir: directory under which the "dump" dir is created
+    :param only: list of DB or DB.COLLECTION names to rebuild, all if empty
+    :param jobs: number of files to rebuild in parallel
+    :param spools: list of the spool dirs to spread the DBs over
+    '''
+    recipe_path = os.path.join(store, mongo_mms_export.STORE_RECIPES, recipe)
+    if not os.path.isfile(recipe_path):
+        mongo_mms_export.fatal("Can't find the recipe %s in the store %s" % (recipe, store))
+    files = []
+    missing = 0
+    db_sizes = {}
+    recipe_file = open(recipe_path, 'r')
+    for line in recipe_file:
+        (member, chunks) = line.rstrip("\n").split("\t")
+        if not is_member_selected(member, only):
+            continue
+        chunks = [ one_chunk for one_chunk in chunks.split(",") if one_chunk ]
+        for one_chunk in chunks:
+            if not os.path.isfile(os.path.join(store, mongo_mms_export.STORE_CHUNKS, one_chunk[:2], one_chunk)):
+                missing += 1
+        files.append((member, chunks))
+        parts = member.split("/")
+        if len(parts) == 3 and parts[1] != mongo_mms_export.COLLECTIONS_DIR:
+            # The recipe has no sizes, the chunks are about CHUNK_AVG
+            db_sizes[parts[1]] = db_sizes.get(parts[1], 0) + len(chunks) * mongo_mms_export.CHUNK_AVG
+    recipe_file.close()
+    if missing:
+        mongo_mms_export.fatal("%d chunks of %s are missing in the store, the packs of the previous exports must be received first" % (missing, recipe))
+    if spools:
+        spread_over_spools(target_dir, spools, db_sizes)
+    print "Rebuilding the data from the store...",
+    def rebuild_file(one_file):
+        (member, chunks) = one_file
+        target = mongo_mms_export.member_target(target_dir, member)
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # Another thread may have created it
+                if not os.path.isdir(parent):
+                    raise
+        out = open(target, 'wb')
+        for one_chunk in chunks:
+            out.write(read_chunk(store, one_chunk))
+        out.close()
+    mongo_mms_export.parallel_map(rebuild_file, files, jobs)
+    print " done."
+
+def receive_pack(pack, store):
+    '''
+    Add the recipe and the chunks of a pack created by the exporter to the
+    deduplicating store. Return the name of the recipe.
+    :param pack: pack file, see 'mongo_mms_export.package_delta'
+    :param store: directory of the deduplicating store
+    '''
+    print "Adding the pack to the store...",
+    recipe = None
+    tar = tarfile.open(pack, "r")
+    members = tar.getmembers()
+    for member in members:
+        mongo_mms_export.member_target(store, member.name)
+        parts = member.name.split("/")
+        if parts[0] == mongo_mms_export.STORE_RECIPES and len(parts) == 2 and member.isfile():
+            recipe = parts[1]
+        elif parts[0] != mongo_mms_export.STORE_CHUNKS or len(parts) != 3 or not member.isfile():
+            tar.close()
+            mongo_mms_export.fatal("Unexpected file in the pack %s: %s" % (pack, member.name))
+    if recipe is None:
+        tar.close()
+        mongo_mms_export.fatal("No recipe in the pack: %s" % (pack))
+    tar.extractall(path=store, members=members)
+    tar.close()
+    print " done."
+    return recipe
+
+def restore_changed_collections(mongorestore, mongoimport, auth_dict, auth_string, host, port, directory, entries, upsert, force, jobs, mms_version, case_id, background):
+    '''
+    Load the MMS data into our target instance, one collection at a time,
+    skipping the collections already loaded by a previous run.
+    The collections are loaded by priority, see 'get_restore_priority', so
+    the viewer can be used before the older metrics are loaded:
+      - the config and other non metrics DBs
+      - the exported collections, then the defaults are set
+      - the recent metrics, after which the viewer is ready
+      - the older metrics history, in the background with 'background',
+        see 'detach': the import returns once the viewer is ready, and the
+        rest of it, like the final checks, goes on in a child process
+    Each load is recorded in IMPORTER_LOADS, by case, with the checksum and
+    count of the file. A collection is loaded again only if it was never
+    loaded with that checksum for the case, or if that load did not
+    complete, see 'is_entry_loaded'.
+    A collection loaded before for the case from other data has changed:
+    it is loaded with upserts on '_id', see 'upsert_collection', so its
+    documents replace the ones of the previous load instead of being
+    skipped as duplicates by 'mongorestore'.
+    The importer logs are always loaded, to keep a trace of every run.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param directory: root dir of the data to import
+    :param entries: manifest entries of the files to restore
+    :param upsert: upsert/overwrite existing data
+    :param force: load all the collections, even the ones already loaded
+    :param jobs: number of collections to restore in parallel
+    :param mms_version: of the target instance
+    :param case_id: case the data belongs to, from 'get_case_id'
+    :param background: log file of the older metrics restored in the
+        background, or "" to restore them in the foreground
+    '''
+    print "Restoring changed collections"
+    start = time.time()
+    client = get_client(auth_dict, host, port)
+    loads = client[IMPORTER_LOADS[0]][IMPORTER_LOADS[1]]
+    recent_metrics = get_recent_metrics(mms_version, entries)
+    phases = ([], [], [], [])
+    for entry in entries:
+        namespace = mongo_mms_export.member_namespace(entry['path'])
+        if namespace is None:
+            continue
+        is_exported = entry['path'].split("/")[1] == mongo_mms_export.COLLECTIONS_DIR
+        if is_exported and namespace not in COLLECTIONS_TO_IMPORT:
+            continue
+        phases[get_restore_priority(entry, recent_metrics)].append(entry)
+    def load_one(entry):
+        (db, coll) = mongo_mms_export.member_namespace(entry['path'])
+        load_id = get_load_id(entry, case_id)
+        if not force:
+            if is_entry_loaded(loads, entry, case_id):
+                if Verbose:
+                    print "  skipping %s.%s, already loaded" % (db, coll)
+                return False
+        changed = loads.find_one({"db":db, "coll":coll, "case_id":case_id, "_id":{"$ne":load_id}}) is not None
+        print "  %s.%s%s..." % (db, coll, changed and ", changed" or "")
+        loads.update({"_id":load_id}, {"$set":{"db":db, "coll":coll, "case_id":case_id, "sha1":entry['sha1'], "docs":entry['docs'], "complete":False, "start_ts":datetime.datetime.utcnow()}}, upsert=True)
+        filepath = os.path.join(directory, *entry['path'].split("/"))
+        if entry['path'].split("/")[1] == mongo_mms_export.COLLECTIONS_DIR:
+            import_collection(mongoimport, auth_string, host, port, filepath, db, coll, upsert or changed)
+        elif upsert or changed:
+            upsert_collection(auth_dict, host, port, filepath, db, coll)
+        else:
+            restore_collection(mongorestore, auth_string, host, port, filepath, db, coll)
+        loads.update({"_id":load_id}, {"$set":{"complete":True, "end_ts":datetime.datetime.utcnow()}})
+        return True
+    loaded = mongo_mms_export.parallel_map(load_one, phases[PRIORITY_CONFIG], jobs)
+    # Exported collections are small, and imported with 'mongoimport'
+    loaded += mongo_mms_export.parallel_map(load_one, phases[PRIORITY_EXPORTED], 1)
+    (db, coll) = mongo_mms_export.IMPORTER_LOGS
+    json_file = os.path.join(directory, mongo_mms_export.DUMPDIR, mongo_mms_export.COLLECTIONS_DIR, db, coll)
+    import_collection(mongoimport, auth_string, host, port, json_file, db, coll, upsert)
+    set_defaults(auth_dict, host, port, mms_version)
+    loaded += mongo_mms_export.parallel_map(load_one, phases[PRIORITY_RECENT], jobs)
+    print "Viewer ready for use after %ds, %d collections of older metrics are still to restore" % (time.time() - start, len(phases[PRIORITY_HISTORY]))
+    if background and phases[PRIORITY_HISTORY]:
+        detach(background)
+        # The connections of the parent can't be shared with the child
+        client = get_client(auth_dict, host, port)
+        loads = client[IMPORTER_LOADS[0]][IMPORTER_LOADS[1]]
+    loaded += mongo_mms_export.parallel_map(load_one, phases[PRIORITY_HISTORY], jobs)
+    print "  done in %ds, %d collections already loaded were skipped." % (time.time() - start, loaded.count(False))
+
+def restore_collection(mongorestore, auth_string, host, port, bson_file, db, coll):
+    '''
+    Load one collection dumped by 'mongodump' into our target instance.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param bson_file: dumped ".bson" file
+    :param db: target DB
+    :param coll: target collection
+    '''
+    cmd = "%s %s --host %s --port %s -d %s -c %s %s" % (mongorestore, auth_string, host, port, db, coll, bson_file)
+    mongo_mms_export.run_cmd(cmd, abort=True)
+
+def restore_data_files(paths, directory, dbpath, upsert):
+    '''
+    Restore a physical export, made with the exporter's '--dbpath', into
+    the data directory of a stopped MMS viewer instance.
+    The exported data files replace the ones of the viewer, so the viewer
+    data a logical import keeps is saved before and restored after, see
+    'get_viewer_namespaces'. The exported collections are then imported and
+    the defaults set, on a 'mongod' started only for that.
+    :param paths: paths of the tools, from 'find_paths'
+    :param directory: root dir of the data to import
+    :param dbpath: data directory of the stopped viewer instance
+    :param upsert: upsert/overwrite existing data
+    '''
+    source = os.path.join(directory, mongo_mms_export.DUMPDIR, mongo_mms_export.PHYSICAL_DIR)
+    if not os.path.isdir(source):
+        mongo_mms_export.fatal("The data is not a physical export, it can't be restored with '--dbpath'")
+    if not os.path.isdir(dbpath) or not os.listdir(dbpath):
+        mongo_mms_export.fatal("'--dbpath' must be the data directory of an MMS viewer instance started at least once: %s" % (dbpath))
+    logpath = os.path.join(directory, mongo_mms_export.LOCAL_MONGOD_LOG)
+    saved_dir = os.path.join(directory, VIEWER_CONFIG_DIR)
+    data_mms_version = get_data_mms_version(os.path.join(directory, mongo_mms_export.DUMPDIR))
+    namespaces = get_viewer_namespaces()
+    print "Saving the users and the MMS config of the viewer..."
+    port = mongo_mms_export.start_local_mongod(paths['mongod'], dbpath, logpath)
+    try:
+        mms_version = get_mms_version(None, mongo_mms_export.LOCALHOST, port)
+        if data_mms_version != mms_version:
+            mongo_mms_export.fatal("Can't import MMS data in version %s into a MMS server version %s" % (data_mms_version, mms_version))
+        for (db, coll) in namespaces:
+            cmd = "%s --host %s --port %s --db %s --out %s" % (paths['mongodump'], mongo_mms_export.LOCALHOST, port, db, saved_dir)
+            if coll:
+                cmd += " --collection %s" % (coll)
+            mongo_mms_export.run_cmd(cmd, abort=True)
+    finally:
+        mongo_mms_export.stop_local_mongod(paths['mongod'], dbpath)
+    print "Replacing the data files..."
+    for name in os.listdir(dbpath):
+        path = os.path.join(dbpath, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    for name in os.listdir(source):
+        shutil.move(os.path.join(source, name), os.path.join(dbpath, name))
+    print "Restoring the viewer data and the exported collections..."
+    port = mongo_mms_export.start_local_mongod(paths['mongod'], dbpath, logpath)
+    try:
+        client = get_client(None, mongo_mms_export.LOCALHOST, port)
+        for (db, coll) in namespaces:
+            if coll:
+                client[db].drop_collection(coll)
+                source = os.path.join(saved_dir, db, coll + ".bson")
+            else:
+                # The exported users and config of the customer
+                for one_coll in client[db].collection_names():
+                    if one_coll != "system.indexes":
+                        client[db].drop_collection(one_coll)
+                source = os.path.join(saved_dir, db)
+            cmd = "%s --host %s --port %s --db %s" % (paths['mongorestore'], mongo_mms_export.LOCALHOST, port, db)
+            if coll:
+                cmd += " --collection %s" % (coll)
+            mongo_mms_export.run_cmd("%s %s" % (cmd, source), abort=True)
+        for db_coll in COLLECTIONS_TO_IMPORT:
+            (db, coll) = db_coll
+            json_file = os.path.join(directory, mongo_mms_export.DUMPDIR, mongo_mms_export.COLLECTIONS_DIR, db, coll)
+            import_collection(paths['mongoimport'], "", mongo_mms_export.LOCALHOST, port, json_file, db, coll, upsert)
+        set_defaults(None, mongo_mms_export.LOCALHOST, port, mms_version)
+    finally:
+        mongo_mms_export.stop_local_mongod(paths['mongod'], dbpath)
+    print "  done."
+
 def restore_database(mongorestore, mongoimport, auth_string, host, port, directory, upsert):
     '''
     Load the MMS data into our target instance.
@@ -172,10 +815,7 @@ def restore_database(mongorestore, mongoimport, auth_string, host, port, directo
     for db_coll in COLLECTIONS_TO_IMPORT:
         (db, coll) = db_coll
         json_file = os.path.join(directory, mongo_mms_export.DUMPDIR, mongo_mms_export.COLLECTIONS_DIR, db, coll)
-        cmd = "%s %s --host %s --port %s -d %s -c %s --file %s" % (mongoimport, auth_string, host, port, db, coll, json_file)
-        if upsert:
-            cmd = cmd + " --upsert"
-        mongo_mms_export.run_cmd(cmd, abort=True)
+        import_collection(mongoimport, auth_string, host, port, json_file, db, coll, upsert)
     # show groups being restored
     print "  done."
   
@@ -221,6 +861,95 @@ def set_defaults(auth_dict, host, port, mms_version):
         oid = bson.objectid.ObjectId(oid="4d09359b1cc223ebd7f9797f")
         coll.update({"pe":{"$regex":"mongodb.com"}}, {"$addToSet": {"cids":oid}, "$set":{"xe":True}}, upsert=False, multi=True)
 
+def spread_over_spools(extract_dir, spools, db_sizes):
+    '''
+    Spread the DBs to extract over the temporary dir and the spool dirs, by
+    free space: the largest DBs first, each in the dir with the most space
+    left. The DBs placed in a spool dir are linked in the "dump" dir, see
+    'link_spool', so the restore reads from all the disks at once.
+    :param extract_dir: directory where the "dump" dir is created
+    :param spools: list of the spool dirs
+    :param db_sizes: dict of the size in bytes of each DB
+    '''
+    dump_dir = os.path.join(extract_dir, mongo_mms_export.DUMPDIR)
+    places = [ None ]
+    space_left = [ mongo_mms_export.get_avail_space(os.path.dirname(extract_dir)) * 1024 * 1024 ]
+    for spool in spools:
+        places.append(os.path.join(get_extract_dir(spool), mongo_mms_export.DUMPDIR))
+        space_left.append(mongo_mms_export.get_avail_space(spool) * 1024 * 1024)
+    dbs = db_sizes.keys()
+    dbs.sort(key=lambda db: -db_sizes[db])
+    for one_db in dbs:
+        i = space_left.index(max(space_left))
+        space_left[i] -= db_sizes[one_db]
+        if places[i] is not None:
+            mongo_mms_export.link_spool(dump_dir, places[i], one_db)
+            if Verbose:
+                print "  %s goes to %s" % (one_db, places[i])
+
+def upsert_collection(auth_dict, host, port, bson_file, db, coll):
+    '''
+    Load one dumped collection into our target instance with upserts on
+    '_id', so the documents already there are replaced. Slower than
+    'restore_collection', as the documents are decoded here.
+    :param host: of the target MMS instance
+    :param port: of the target MMS instance
+    :param bson_file: dumped ".bson" file
+    :param db: target DB
+    :param coll: target collection
+    '''
+    target = get_client(auth_dict, host, port)[db][coll]
+    bulk = target.initialize_unordered_bulk_op()
+    pending = 0
+    for raw_doc in mongo_mms_export.iter_bson_docs(bson_file):
+        doc = bson.BSON(raw_doc).decode(**DECODE_OPTIONS)
+        if "_id" in doc:
+            bulk.find({"_id":doc["_id"]}).upsert().replace_one(doc)
+        else:
+            bulk.insert(doc)
+        pending += 1
+        if pending == UPSERT_BATCH:
+            bulk.execute()
+            bulk = target.initialize_unordered_bulk_op()
+            pending = 0
+    if pending:
+        bulk.execute()
+
+def verify_manifest(extract_dir, entries, jobs, verified):
+    '''
+    Check the files to restore against the manifest written by the exporter,
+    before anything is restored. The files are checksummed in parallel.
+    The files already checked when extracted from an indexed archive, with
+    the same SHA1 as in the manifest, are not read again.
+    :param extract_dir: directory where the "dump" dir is located
+    :param entries: manifest entries of the files to restore
+    :param jobs: number of files to checksum in parallel
+    :param verified: set of the (path, sha1) of the files already checked
+    '''
+    print "Verifying the data against the manifest...",
+    entries = [ entry for entry in entries if (entry['path'], entry['sha1']) not in verified ]
+    problems = mongo_mms_export.parallel_map(lambda entry: verify_manifest_entry(extract_dir, entry), entries, jobs)
+    print " done."
+    if Verbose:
+        print "  checksummed %d files" % (len(entries))
+    problems = [one_problem for one_problem in problems if one_problem]
+    if problems:
+        mongo_mms_export.fatal("The data does not match its manifest, it may have been corrupted during the transfer:\n  %s" % ("\n  ".join(problems)))
+
+def verify_manifest_entry(extract_dir, entry):
+    '''
+    Return a description of the problem if a file does not match its
+    manifest entry, None otherwise.
+    :param extract_dir: directory where the "dump" dir is located
+    :param entry: manifest entry of the file
+    '''
+    if not os.path.isfile(os.path.join(extract_dir, *entry['path'].split("/"))):
+        return "missing file: %s" % (entry['path'])
+    info = mongo_mms_export.get_file_info(extract_dir, entry['path'], count=False)
+    if info['size'] != entry['size'] or info['sha1'] != entry['sha1']:
+        return "bad checksum: %s" % (entry['path'])
+    return None
+
 def show_imported_groups(extract_dir):
     groups = []
     coll_filepath = os.path.join(extract_dir, mongo_mms_export.DUMPDIR, mongo_mms_export.COLLECTIONS_DIR, mongo_mms_export.COLLECTION_WITH_GROUPS[0], mongo_mms_export.COLLECTION_WITH_GROUPS[1])
@@ -247,6 +976,8 @@ def main():
         print "Verbose mode on, will show more info..."
         print "%s version %s" % (TOOL, VERSION)
         print "Running Python version %s" % (sys.version)
+    if options.profile:
+        mongo_mms_export.start_profiling(options.profile)
     auth_string = ''
     auth_dict = None
     if options.username or options.password:
@@ -258,40 +989,101 @@ def main():
             auth_dict['username'] = options.username
             auth_dict['password'] = options.password
             auth_dict['auth_database'] = mongo_mms_export.AUTH_DB
+    for spool in options.spool:
+        if not os.path.isdir(spool):
+            mongo_mms_export.fatal("Can't find the spool directory: %s" % (spool))
+    if options.dbpath and (not options.data or options.only):
+        mongo_mms_export.fatal("'--dbpath' needs '--data', and can't be used with '--only'")
+    if options.background and (options.dbpath or not hasattr(os, "fork")):
+        mongo_mms_export.fatal("'--background' needs a system with 'fork', and can't be used with '--dbpath'")
+    if options.list:
+        if not options.data or not os.path.isfile(options.data) or not mongo_mms_export.is_indexed_archive(options.data):
+            mongo_mms_export.fatal("'--list' needs an indexed archive given with '--data'")
+        list_archive(options.data)
+        return
     try:
         options.host = mongo_mms_export.get_host(options.host)
         paths = mongo_mms_export.find_paths(DEPS)
-        mms_version = get_mms_version(auth_dict, options.host, options.port)
+        mms_version = None
+        if options.dbpath:
+            # The viewer is stopped, its version is checked once its files are found
+            paths.update(mongo_mms_export.find_paths(PHYSICAL_DEPS))
+        else:
+            mms_version = get_mms_version(auth_dict, options.host, options.port)
+        defaults_set = False
         if options.data:
             need_rm_extract_dir = False
-            if not os.path.exists(options.data):
+            verified = set()
+            if options.store:
+                extract_dir = get_extract_dir(options.tmpdir)
+                need_rm_extract_dir = True
+                recipe = options.data
+                if os.path.isfile(options.data):
+                    recipe = receive_pack(options.data, options.store)
+                rebuild_dump(options.store, recipe, extract_dir, options.only, options.jobs, options.spool)
+            elif not os.path.exists(options.data):
                 mongo_mms_export.fatal("Can't find gzip file or directory to import: %s" % (options.data))
-            if os.path.isfile(options.data):
-                extract_dir = os.path.join(options.tmpdir, str(PID))
-                #need_rm_extract_dir = True
-                if os.path.exists(extract_dir):
-                    mongo_mms_export.warning("Remove previously left over temp dir: %s" % (extract_dir))
-                    shutil.rmtree(extract_dir)
-                explode_gzip(options.data, extract_dir)
+            elif os.path.isfile(options.data):
+                extract_dir = get_extract_dir(options.tmpdir)
+                need_rm_extract_dir = True
+                if mongo_mms_export.is_indexed_archive(options.data):
+                    # Check the version first, it is cheap to read from the index
+                    data_mms_version = get_archive_mms_version(options.data)
+                    if data_mms_version != mms_version and not options.dbpath:
+                        mongo_mms_export.fatal("Can't import MMS data in version %s into a MMS server version %s" % (data_mms_version, mms_version))
+                    extracted = explode_archive(options.data, extract_dir, options.only, options.jobs, options.spool)
+                    verified = set([ (entry['path'], entry['sha1']) for entry in extracted ])
+                else:
+                    if options.only:
+                        mongo_mms_export.warning("'--only' needs an indexed archive, extracting everything")
+                    if options.spool:
+                        mongo_mms_export.warning("'--spool' needs an indexed archive, a tar.gz is a single stream extracted in '--tmpdir'")
+                    explode_gzip(options.data, extract_dir)
             elif os.path.isdir(options.data):
                 # Assume the format and contents is already right
                 extract_dir = options.data
+                if options.spool:
+                    mongo_mms_export.warning("'--spool' is ignored when importing a directory")
             dump_dir = os.path.join(extract_dir, mongo_mms_export.DUMPDIR)
             if not os.path.exists(dump_dir):
                 mongo_mms_export.fatal("Can't find the dump directory to restore: %s" % (dump_dir))
+            mongo_mms_export.decode_timeseries_dump(extract_dir, options.jobs)
             data_mms_version = get_data_mms_version(dump_dir)
-            if data_mms_version != mms_version:
+            if data_mms_version != mms_version and not options.dbpath:
                 mongo_mms_export.fatal("Can't import MMS data in version %s into a MMS server version %s" % (data_mms_version, mms_version))
+            entries = get_manifest_entries(extract_dir, options.only)
+            case_id = get_case_id(dump_dir)
+            if entries is not None and not options.noverify:
+                to_verify = entries
+                if not options.dbpath:
+                    # A re-run only checks the collections it will load again
+                    to_verify = get_entries_to_load(auth_dict, options.host, options.port, entries, options.force, case_id)
+                verify_manifest(extract_dir, to_verify, options.jobs, verified)
             groups = show_imported_groups(extract_dir)
             clean_data(dump_dir)
             add_data(dump_dir, groups)
-            restore_database(paths['mongorestore'], paths['mongoimport'], auth_string, options.host, options.port, extract_dir, options.upsert)
-            # Clean the dump tree
-            if need_rm_extract_dir:
+            if options.dbpath:
+                restore_data_files(paths, extract_dir, options.dbpath, options.upsert)
+                defaults_set = True
+            elif entries is not None:
+                restore_changed_collections(paths['mongorestore'], paths['mongoimport'], auth_dict, auth_string, options.host, options.port, extract_dir, entries, options.upsert, options.force, options.jobs, mms_version, case_id, options.background)
+                defaults_set = True
+                if not options.noverify:
+                    check_restored_counts(auth_dict, options.host, options.port, entries, options.jobs)
+            else:
+                restore_database(paths['mongorestore'], paths['mongoimport'], auth_string, options.host, options.port, extract_dir, options.upsert)
+            # Clean the extracted data once imported, a service like
+            # 'mongo_mms_importd' would fill the temp dirs otherwise
+            if need_rm_extract_dir and not mongo_mms_export.Errors:
                 if Verbose:
                     print "Removing temp dump directory"
                 shutil.rmtree(extract_dir)
-        set_defaults(auth_dict, options.host, options.port, mms_version)
+                for spool in options.spool:
+                    spool_dir = os.path.join(spool, str(PID))
+                    if os.path.exists(spool_dir):
+                        shutil.rmtree(spool_dir)
+        if not defaults_set:
+            set_defaults(auth_dict, options.host, options.port, mms_version)
             
     except Exception, e:
         mongo_mms_export.error("caught exception:\n  " + e.__str__())
@@ -299,6 +1091,7 @@ def main():
             traceback.print_exc()
     if mongo_mms_export.Errors:
         print "The script terminated with errors"
+        sys.exit(1)
     
          
 if __name__ == '__main__':
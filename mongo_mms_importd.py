@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+'''
+Created in January 2014
+
+@author: Daniel Coupal
+
+Service to import MMS exports as they are dropped in an inbox directory.
+  - it watches the inbox for new '.gzip' and '.mmsa' archives
+  - it queues them, and runs 'mongo_mms_import' for each one on one of the
+    MMS viewer instances given as targets
+  - several archives are imported at once, up to a limit per target
+  - imported archives are moved to 'done', the ones that failed to 'failed'
+
+Instructions for using the tools are at:
+  https://wiki.mongodb.com/display/cs/MMS+Exporter+and+Importer
+
+Pre-requisites:
+  - Python < 2.3 and > 3.0
+  - the same as 'mongo_mms_import'
+
+Implementation details:
+  - The state is kept in a '.importd' dir in the inbox: the job queue, the
+    status, the logs of each import and the processed archives. The queue
+    is saved after each change, so a restart does not lose any work. Jobs
+    that were running are queued again, which is safe as the importer skips
+    the collections it already loaded.
+  - An archive is only queued once its size has not changed between two
+    scans, so we don't pick up a file which is still being copied.
+'''
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+
+ROOTDIR = os.path.dirname(__file__)
+sys.path.insert(0, ROOTDIR)
+import mongo_mms_export
+
+TOOL = "mongo_mms_importd"
+VERSION = "0.1.0"
+
+ARCHIVE_EXTS = (".gzip", mongo_mms_export.ARCHIVE_EXT)
+DEFAULT_TARGET = "localhost:27017:1"
+IMPORTER = os.path.join(ROOTDIR, "mongo_mms_import.py")
+STATE_DIR = ".importd"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+STATE_LOGS = "logs"
+STATE_QUEUE = "queue"
+STATE_STATUS = "status"
+
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+
+Verbose = False
+
+def get_opts():
+    '''
+    Read the options and arguments provided on the command line.
+    '''
+    parser = optparse.OptionParser(version="%prog " + VERSION)
+    group_general = optparse.OptionGroup(parser, "General options")
+    parser.add_option_group(group_general)
+    group_general.add_option("-i", "--inbox", dest="inbox", type="string", default="", help="directory to watch for new archives", metavar="DIR")
+    group_general.add_option("--interval", dest="interval", type="int", default=10, help="seconds between two scans of the inbox", metavar="SECONDS")
+    group_general.add_option("--once", dest="once", action="store_true", default=False, help="import the archives in the inbox, then exit")
+    group_general.add_option("--target", dest="targets", action="append", default=[], help="MMS viewer to import into, with the maximum number of imports to run on it at once, default %s. Can be repeated" % (DEFAULT_TARGET), metavar="HOST:PORT[:JOBS]")
+    group_general.add_option("-t", "--tmpdir", dest="tmpdir", type="string", default=".", help="temporary dir to use for the restores", metavar="DIR")
+    group_general.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="show more output")
+    group_security = optparse.OptionGroup(parser, "Security options")
+    parser.add_option_group(group_security)
+    group_security.add_option("--password", dest="password", type="string", default='', help="password for a secured MMS DB", metavar="PASSWORD")
+    group_security.add_option("--username", dest="username", type="string", default='', help="username for a secured MMS DB", metavar="USERNAME")
+    (options, args) = parser.parse_args()
+    return options, args
+
+def finish_job(inbox, job, process, tmpdir):
+    '''
+    Record the end of an import, and move its archive out of the inbox.
+    The importer removes its extracted data once imported, what is left
+    after a failure is removed here, so the temp dir does not fill up.
+    :param inbox: directory watched for new archives
+    :param job: job of the finished import
+    :param process: the finished importer
+    :param tmpdir: temp dir given to the importer
+    '''
+    status = process.returncode
+    extract_dir = os.path.join(tmpdir, str(process.pid))
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+    job['end_ts'] = time.time()
+    if status == 0:
+        job['state'] = JOB_DONE
+        target_dir = os.path.join(inbox, STATE_DIR, STATE_DONE)
+    else:
+        job['state'] = JOB_FAILED
+        target_dir = os.path.join(inbox, STATE_DIR, STATE_FAILED)
+    archive_path = os.path.join(inbox, job['archive'])
+    if os.path.exists(archive_path):
+        shutil.move(archive_path, os.path.join(target_dir, job['archive']))
+    message = "%s %s on %s in %ds, %.1f MB/s" % (job['archive'], job['state'], job['target'], job['end_ts'] - job['start_ts'], get_throughput(job))
+    if status == 0:
+        print message
+    else:
+        mongo_mms_export.error("%s, see %s" % (message, get_log_path(inbox, job)))
+
+def get_log_path(inbox, job):
+    '''
+    Return the path of the file receiving the output of an import.
+    :param inbox: directory watched for new archives
+    :param job: job of the import
+    '''
+    return os.path.join(inbox, STATE_DIR, STATE_LOGS, job['archive'] + ".log")
+
+def get_targets(target_specs):
+    '''
+    Parse the '--target' options.
+    Return a list of dicts with the keys: 'name', 'host', 'port' and 'jobs'.
+    :param target_specs: list of HOST:PORT[:JOBS] strings
+    '''
+    targets = []
+    if not target_specs:
+        target_specs = [ DEFAULT_TARGET ]
+    for one_spec in target_specs:
+        items = one_spec.split(":")
+        if len(items) == 2:
+            items.append("1")
+        if len(items) != 3 or not items[1].isdigit() or not items[2].isdigit() or int(items[2]) < 1:
+            mongo_mms_export.fatal("Invalid target, expecting HOST:PORT[:JOBS]: %s" % (one_spec))
+        host = mongo_mms_export.get_host(items[0])
+        targets.append({'name':"%s:%s" % (host, items[1]), 'host':host, 'port':items[1], 'jobs':int(items[2])})
+    return targets
+
+def get_throughput(job):
+    '''
+    Return the throughput of a finished import in MB/s of archive.
+    :param job: job of the import
+    '''
+    elapsed = max(job['end_ts'] - job['start_ts'], 0.001)
+    return job['size'] / (1024.0 * 1024.0) / elapsed
+
+def load_queue(inbox):
+    '''
+    Load the job queue saved by 'save_queue'.
+    Jobs that were running when the service stopped are queued again.
+    :param inbox: directory watched for new archives
+    '''
+    jobs = []
+    queue_path = os.path.join(inbox, STATE_DIR, STATE_QUEUE)
+    if os.path.isfile(queue_path):
+        queue_file = open(queue_path, 'r')
+        for line in queue_file:
+            (state, archive, target, size, queued_ts, start_ts, end_ts) = line.rstrip("\n").split("\t")
+            if state == JOB_RUNNING:
+                mongo_mms_export.warning("Import of %s was interrupted, queuing it again" % (archive))
+                (state, target, start_ts) = (JOB_QUEUED, "", "0")
+            jobs.append({'state':state, 'archive':archive, 'target':target, 'size':int(size), 'queued_ts':float(queued_ts), 'start_ts':float(start_ts), 'end_ts':float(end_ts)})
+        queue_file.close()
+    return jobs
+
+def save_queue(inbox, jobs):
+    '''
+    Save the job queue, replacing the previous one in a single rename.
+    :param inbox: directory watched for new archives
+    :param jobs: all the jobs
+    '''
+    queue_path = os.path.join(inbox, STATE_DIR, STATE_QUEUE)
+    queue_file = open(queue_path + ".tmp", 'w')
+    for job in jobs:
+        queue_file.write("%s\t%s\t%s\t%d\t%f\t%f\t%f\n" % (job['state'], job['archive'], job['target'], job['size'], job['queued_ts'], job['start_ts'], job['end_ts']))
+    queue_file.close()
+    os.rename(queue_path + ".tmp", queue_path)
+
+def scan_inbox(inbox, jobs, sizes):
+    '''
+    Queue the new archives found in the inbox.
+    An archive is queued once its size is the same as at the previous scan.
+    Return the number of new jobs.
+    :param inbox: directory watched for new archives
+    :param jobs: all the jobs, new ones are appended
+    :param sizes: sizes of the unqueued archives at the previous scan
+    '''
+    known = dict()
+    for job in jobs:
+        if job['state'] in (JOB_QUEUED, JOB_RUNNING):
+            known[job['archive']] = True
+    new_jobs = 0
+    names = sorted(os.listdir(inbox))
+    for name in sizes.keys():
+        if name not in names:
+            del sizes[name]
+    for name in names:
+        archive_path = os.path.join(inbox, name)
+        if name in known or not os.path.isfile(archive_path) or not name.endswith(ARCHIVE_EXTS):
+            continue
+        size = os.path.getsize(archive_path)
+        if sizes.get(name) != size:
+            sizes[name] = size
+            continue
+        del sizes[name]
+        jobs.append({'state':JOB_QUEUED, 'archive':name, 'target':"", 'size':size, 'queued_ts':time.time(), 'start_ts':0.0, 'end_ts':0.0})
+        new_jobs += 1
+        if Verbose:
+            print "Queued %s, %d MB" % (name, size / (1024 * 1024))
+    return new_jobs
+
+def start_job(inbox, job, target, options):
+    '''
+    Start 'mongo_mms_import' for a job on a target.
+    Return the running process.
+    :param inbox: directory watched for new archives
+    :param job: job to start
+    :param target: target MMS viewer, from 'get_targets'
+    :param options: options of the service, passed to the importer
+    '''
+    cmd = [ sys.executable, IMPORTER, "--data", os.path.join(inbox, job['archive']), "--host", target['host'], "--port", target['port'], "--tmpdir", options.tmpdir ]
+    if options.username:
+        cmd.extend([ "--username", options.username, "--password", options.password ])
+    if Verbose:
+        cmd.append("--verbose")
+    print "Importing %s into %s" % (job['archive'], target['name'])
+    log_file = open(get_log_path(inbox, job), 'a')
+    process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+    log_file.close()
+    job['state'] = JOB_RUNNING
+    job['target'] = target['name']
+    job['start_ts'] = time.time()
+    return process
+
+def write_status(inbox, jobs, targets, running):
+    '''
+    Write the status of the service: the queue depth, the load of each
+    target, and the throughput of the finished imports.
+    :param inbox: directory watched for new archives
+    :param jobs: all the jobs
+    :param targets: targets from 'get_targets'
+    :param running: dict of the running processes, by archive name
+    '''
+    queued = [ job for job in jobs if job['state'] == JOB_QUEUED ]
+    lines = [ "queue depth: %d" % (len(queued)), "running: %d" % (len(running)) ]
+    for target in targets:
+        load = len([ job for job in jobs if job['state'] == JOB_RUNNING and job['target'] == target['name'] ])
+        lines.append("target %s: %d/%d" % (target['name'], load, target['jobs']))
+    for job in jobs:
+        if job['state'] in (JOB_DONE, JOB_FAILED):
+            lines.append("%s %s on %s: %d MB in %ds, %.1f MB/s" % (job['state'], job['archive'], job['target'], job['size'] / (1024 * 1024), job['end_ts'] - job['start_ts'], get_throughput(job)))
+        elif job['state'] == JOB_RUNNING:
+            lines.append("running %s on %s for %ds" % (job['archive'], job['target'], time.time() - job['start_ts']))
+    status_path = os.path.join(inbox, STATE_DIR, STATE_STATUS)
+    status_file = open(status_path + ".tmp", 'w')
+    status_file.write("\n".join(lines) + "\n")
+    status_file.close()
+    os.rename(status_path + ".tmp", status_path)
+
+def main():
+    '''
+    The main module.
+    '''
+    global Verbose
+    sys.stdout = mongo_mms_export.flushfile(sys.stdout)
+    (options, args) = get_opts()
+    if args:
+        mongo_mms_export.fatal("Found trailing arguments: %s" % (str(args)))
+    if options.verbose:
+        Verbose = True
+        mongo_mms_export.Verbose = True
+        print "Verbose mode on, will show more info..."
+        print "%s version %s" % (TOOL, VERSION)
+        print "Running Python version %s" % (sys.version)
+    if not options.inbox or not os.path.isdir(options.inbox):
+        mongo_mms_export.fatal("You must provide an existing inbox directory with '--inbox'")
+    if (options.username or options.password) and not (options.username and options.password):
+        mongo_mms_export.fatal("You must provide both: --username and --password")
+    targets = get_targets(options.targets)
+    for one_dir in (STATE_DONE, STATE_FAILED, STATE_LOGS):
+        state_path = os.path.join(options.inbox, STATE_DIR, one_dir)
+        if not os.path.isdir(state_path):
+            os.makedirs(state_path)
+    jobs = load_queue(options.inbox)
+    running = dict()
+    sizes = dict()
+    try:
+        while True:
+            changed = scan_inbox(options.inbox, jobs, sizes)
+            # Reap the finished imports
+            for job in jobs:
+                if job['state'] == JOB_RUNNING and running[job['archive']].poll() is not None:
+                    finish_job(options.inbox, job, running.pop(job['archive']), options.tmpdir)
+                    changed = True
+            # Start the queued imports on the least loaded targets
+            for job in jobs:
+                if job['state'] != JOB_QUEUED:
+                    continue
+                best_target = None
+                best_load = 0
+                for target in targets:
+                    load = len([ one_job for one_job in jobs if one_job['state'] == JOB_RUNNING and one_job['target'] == target['name'] ])
+                    if load < target['jobs'] and (best_target is None or float(load) / target['jobs'] < best_load):
+                        best_target = target
+                        best_load = float(load) / target['jobs']
+                if best_target is None:
+                    break
+                running[job['archive']] = start_job(options.inbox, job, best_target, options)
+                changed = True
+            if changed:
+                save_queue(options.inbox, jobs)
+                write_status(options.inbox, jobs, targets, running)
+                if Verbose:
+                    print "Queue depth: %d, running: %d" % (len([ job for job in jobs if job['state'] == JOB_QUEUED ]), len(running))
+            if options.once and not running and not sizes and not [ job for job in jobs if job['state'] == JOB_QUEUED ]:
+                break
+            time.sleep(options.interval)
+    except KeyboardInterrupt:
+        print "\nStopping, %d running imports will be queued again at the next start" % (len(running))
+    except Exception, e:
+        mongo_mms_export.error("caught exception:\n  " + e.__str__())
+        if Verbose:
+            traceback.print_exc()
+    save_queue(options.inbox, jobs)
+    if mongo_mms_export.Errors:
+        print "The script terminated with errors"
+
+if __name__ == '__main__':
+    main()
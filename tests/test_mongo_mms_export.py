@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+'''
+Tests of the file formats and the pure functions of 'mongo_mms_export.py':
+the indexed archive, the manifest, the columnar encoding of the metrics,
+the deduplicating store and the merge of the shard dumps.
+
+Run with: python -m unittest discover -s tests
+'''
+
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOTDIR)
+import mongo_mms_export
+
+def bson_element(key, value):
+    '''
+    Return a BSON element, for the few types the tests use.
+    :param key: name of the field
+    :param value: float, int, long, str, dict, or a (type, data) tuple for
+        any other type, like a date or an ObjectId
+    '''
+    if isinstance(value, tuple):
+        return value[0] + key + "\x00" + value[1]
+    if isinstance(value, float):
+        return "\x01" + key + "\x00" + struct.pack("<d", value)
+    if isinstance(value, str):
+        return "\x02" + key + "\x00" + struct.pack("<i", len(value) + 1) + value + "\x00"
+    if isinstance(value, list):
+        return "\x03" + key + "\x00" + bson_doc(value)
+    if isinstance(value, long):
+        return "\x12" + key + "\x00" + struct.pack("<q", value)
+    if isinstance(value, bool):
+        return "\x08" + key + "\x00" + (value and "\x01" or "\x00")
+    if isinstance(value, int):
+        return "\x10" + key + "\x00" + struct.pack("<i", value)
+    raise ValueError("Unsupported value: %r" % (value,))
+
+def bson_doc(fields):
+    '''
+    Return a BSON document.
+    :param fields: list of (key, value) pairs, see 'bson_element'
+    '''
+    body = "".join([ bson_element(key, value) for (key, value) in fields ])
+    return struct.pack("<i", len(body) + 5) + body + "\x00"
+
+def bson_date(millis):
+    return ("\x09", struct.pack("<q", millis))
+
+def bson_oid(number):
+    return ("\x07", struct.pack(">iq", 0, number))
+
+def make_samples(count, start=0):
+    '''
+    Return the BSON of metrics samples, like the ones of "mmsdbrrd", with a
+    few documents of other shapes mixed in.
+    :param count: number of documents
+    :param start: first sample number
+    '''
+    docs = []
+    for i in range(start, start + count):
+        if i % 50 == 7:
+            docs.append(bson_doc([ ("_id", bson_oid(i)), ("note", "odd\x00one %d" % (i)), ("flag", True) ]))
+        elif i % 50 == 8:
+            docs.append(bson_doc([]))
+        else:
+            docs.append(bson_doc([ ("_id", bson_oid(i)), ("hid", "host-%d" % (i % 3)), ("ts", bson_date(1400000000000 + i * 60000)),
+                                   ("v", float(i) / 3), ("n", i), ("l", long(i) << 33), ("sub", [ ("a", i % 5), ("b", "x") ]) ]))
+    return "".join(docs)
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    out = open(path, 'wb')
+    out.write(data)
+    out.close()
+
+def read_file(path):
+    in_file = open(path, 'rb')
+    data = in_file.read()
+    in_file.close()
+    return data
+
+def make_dump(directory):
+    '''
+    Create a small "dump" tree, and return its files and their contents.
+    :param directory: directory where the "dump" dir is created
+    '''
+    files = {
+        "dump/mms_version": "1.3\n",
+        "dump/mmsdbconfig/config.customers.bson": make_samples(3),
+        "dump/mmsdbconfig/config.customers.metadata.json": '{"indexes":[]}',
+        "dump/mmsdbrrd/data.minute.bson": make_samples(400),
+        "dump/_collections/importer/logs": '{"case_id":"12345"}\n{"case_id":"12346"}\n',
+    }
+    for (member, data) in files.items():
+        write_file(os.path.join(directory, *member.split("/")), data)
+    return files
+
+class TempDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_mms_")
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+class ArchiveTest(TempDirTest):
+
+    def check_round_trip(self, jobs):
+        files = make_dump(self.tmpdir)
+        archive = os.path.join(self.tmpdir, "data" + mongo_mms_export.ARCHIVE_EXT)
+        mongo_mms_export.write_archive(self.tmpdir, archive, jobs)
+        self.assertTrue(mongo_mms_export.is_indexed_archive(archive))
+        entries = mongo_mms_export.read_archive_index(archive)
+        self.assertEqual(sorted(files.keys()), [ entry['path'] for entry in entries ])
+        target_dir = os.path.join(self.tmpdir, "out")
+        for entry in entries:
+            target = mongo_mms_export.extract_archive_member(archive, entry, target_dir)
+            self.assertEqual(files[entry['path']], read_file(target))
+            self.assertEqual(files[entry['path']], mongo_mms_export.read_archive_member(archive, entry))
+            self.assertEqual(len(files[entry['path']]), entry['size'])
+        docs = dict([ (entry['path'], entry['docs']) for entry in entries ])
+        self.assertEqual(400, docs["dump/mmsdbrrd/data.minute.bson"])
+        self.assertEqual(2, docs["dump/_collections/importer/logs"])
+        self.assertEqual(0, docs["dump/mms_version"])
+
+    def test_round_trip(self):
+        self.check_round_trip(1)
+
+    def test_round_trip_parallel(self):
+        self.check_round_trip(3)
+
+    def test_corrupted_member(self):
+        make_dump(self.tmpdir)
+        archive = os.path.join(self.tmpdir, "data" + mongo_mms_export.ARCHIVE_EXT)
+        mongo_mms_export.write_archive(self.tmpdir, archive)
+        entry = mongo_mms_export.read_archive_index(archive)[0]
+        entry['sha1'] = "0" * 40
+        self.assertRaises(Exception, mongo_mms_export.extract_archive_member, archive, entry, os.path.join(self.tmpdir, "out"))
+
+    def test_truncated_archive(self):
+        make_dump(self.tmpdir)
+        archive = os.path.join(self.tmpdir, "data" + mongo_mms_export.ARCHIVE_EXT)
+        mongo_mms_export.write_archive(self.tmpdir, archive)
+        data = read_file(archive)
+        write_file(archive, data[:-1])
+        self.assertRaises(Exception, mongo_mms_export.read_archive_index, archive)
+
+    def test_not_an_archive(self):
+        path = os.path.join(self.tmpdir, "data.gzip")
+        write_file(path, "\x1f\x8b" + "x" * 100)
+        self.assertFalse(mongo_mms_export.is_indexed_archive(path))
+
+    def test_unsafe_member(self):
+        archive = os.path.join(self.tmpdir, "data" + mongo_mms_export.ARCHIVE_EXT)
+        target_dir = os.path.join(self.tmpdir, "out")
+        for path in ("../evil", "dump/../../evil", "/tmp/evil", "dump/.."):
+            entry = {'path':path, 'offset':0, 'csize':0, 'size':0, 'docs':0, 'sha1':""}
+            self.assertRaises(Exception, mongo_mms_export.extract_archive_member, archive, entry, target_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil")))
+
+class MemberTest(unittest.TestCase):
+
+    def test_member_target(self):
+        self.assertEqual(os.path.join("out", "dump", "db", "c.bson"), mongo_mms_export.member_target("out", "dump/db/c.bson"))
+        self.assertEqual(os.path.join("/x", "dump", "a..b"), mongo_mms_export.member_target("/x", "dump/a..b"))
+        for path in ("..", "../x", "dump/../../x", "/etc/passwd", "", "."):
+            self.assertRaises(Exception, mongo_mms_export.member_target, "out", path)
+
+    def test_member_namespace(self):
+        self.assertEqual(("mmsdb", "data.hosts"), mongo_mms_export.member_namespace("dump/mmsdb/data.hosts.bson"))
+        self.assertEqual(("importer", "logs"), mongo_mms_export.member_namespace("dump/_collections/importer/logs"))
+        self.assertEqual(None, mongo_mms_export.member_namespace("dump/mmsdb/data.hosts.metadata.json"))
+        self.assertEqual(None, mongo_mms_export.member_namespace("dump/mms_version"))
+
+class ManifestTest(TempDirTest):
+
+    def test_round_trip(self):
+        files = make_dump(self.tmpdir)
+        mongo_mms_export.write_manifest(self.tmpdir, 2)
+        entries = mongo_mms_export.read_manifest(self.tmpdir)
+        self.assertEqual(sorted(files.keys()), [ entry['path'] for entry in entries ])
+        for entry in entries:
+            self.assertEqual(mongo_mms_export.get_file_info(self.tmpdir, entry['path']), entry)
+        docs = dict([ (entry['path'], entry['docs']) for entry in entries ])
+        self.assertEqual(3, docs["dump/mmsdbconfig/config.customers.bson"])
+
+    def test_no_manifest(self):
+        make_dump(self.tmpdir)
+        self.assertEqual(None, mongo_mms_export.read_manifest(self.tmpdir))
+
+    def test_checksum(self):
+        make_dump(self.tmpdir)
+        member = "dump/mmsdbrrd/data.minute.bson"
+        info = mongo_mms_export.get_file_info(self.tmpdir, member)
+        path = os.path.join(self.tmpdir, *member.split("/"))
+        data = read_file(path)
+        write_file(path, data[:100] + chr(ord(data[100]) ^ 1) + data[101:])
+        changed = mongo_mms_export.get_file_info(self.tmpdir, member)
+        self.assertEqual(info['size'], changed['size'])
+        self.assertNotEqual(info['sha1'], changed['sha1'])
+        self.assertEqual(None, mongo_mms_export.get_file_info(self.tmpdir, member, count=False)['docs'])
+
+class CountDocsTest(TempDirTest):
+
+    def test_bson(self):
+        path = os.path.join(self.tmpdir, "c.bson")
+        write_file(path, make_samples(120))
+        self.assertEqual(120, mongo_mms_export.count_docs(path))
+        write_file(path, "")
+        self.assertEqual(0, mongo_mms_export.count_docs(path))
+
+    def test_truncated_bson(self):
+        path = os.path.join(self.tmpdir, "c.bson")
+        data = make_samples(10)
+        for bad in (data[:-1], data + "\x01\x00", data + struct.pack("<i", 0), data + struct.pack("<i", -8) + "\x00" * 8):
+            write_file(path, bad)
+            self.assertRaises(Exception, mongo_mms_export.count_docs, path)
+
+    def test_json(self):
+        path = os.path.join(self.tmpdir, mongo_mms_export.COLLECTIONS_DIR, "db", "coll")
+        write_file(path, '{"a":1}\n\n{"a":2}\n{"a":3}')
+        self.assertEqual(3, mongo_mms_export.count_docs(path))
+
+    def test_other(self):
+        path = os.path.join(self.tmpdir, "c.metadata.json")
+        write_file(path, '{"a":1}\n{"a":2}\n')
+        self.assertEqual(0, mongo_mms_export.count_docs(path))
+
+class TimeseriesTest(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.block = mongo_mms_export.TIMESERIES_BLOCK
+        # Several blocks, with the documents of the tests
+        mongo_mms_export.TIMESERIES_BLOCK = 4096
+
+    def tearDown(self):
+        mongo_mms_export.TIMESERIES_BLOCK = self.block
+        TempDirTest.tearDown(self)
+
+    def check_round_trip(self, data, pool=None, jobs=1):
+        bson_path = os.path.join(self.tmpdir, "c.bson")
+        encoded = os.path.join(self.tmpdir, "c" + mongo_mms_export.TIMESERIES_EXT)
+        decoded = os.path.join(self.tmpdir, "d.bson")
+        write_file(bson_path, data)
+        mongo_mms_export.encode_timeseries(bson_path, encoded, pool, jobs)
+        self.assertEqual(mongo_mms_export.count_docs(bson_path), mongo_mms_export.count_docs(encoded))
+        mongo_mms_export.decode_timeseries(encoded, decoded, pool, jobs)
+        self.assertEqual(data, read_file(decoded))
+        return encoded
+
+    def test_round_trip(self):
+        encoded = self.check_round_trip(make_samples(500))
+        self.assertEqual(mongo_mms_export.TIMESERIES_MAGIC, read_file(encoded)[:len(mongo_mms_export.TIMESERIES_MAGIC)])
+
+    def test_round_trip_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            self.check_round_trip(make_samples(500), pool, 2)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_shapes(self):
+        docs = [
+            bson_doc([ ("a", 1), ("a", 2) ]),
+            bson_doc([ ("a", 1.5), ("b", "") ]),
+            bson_doc([ ("a", "text"), ("b", [ ("c", [ ("d", 1) ]) ]) ]),
+            bson_doc([ ("a", ("\x0A", "")), ("b", ("\x05", struct.pack("<i", 3) + "\x00abc")) ]),
+            bson_doc([ ("a", ("\x0B", "^a.*\x00i\x00")), ("b", ("\x11", struct.pack("<q", 7))) ]),
+        ]
+        self.check_round_trip("".join(docs * 20))
+        self.check_round_trip("")
+
+    def test_single_shape(self):
+        docs = [ bson_doc([ ("_id", bson_oid(i)), ("v", float(i)), ("s", "%d" % (i)) ]) for i in range(300) ]
+        self.check_round_trip("".join(docs))
+
+    def test_block(self):
+        docs = [ bson_doc([ ("n", i), ("s", "x" * (i % 4)) ]) for i in range(30) ] + [ bson_doc([]) ]
+        encoded = mongo_mms_export.encode_timeseries_block(docs)
+        self.assertEqual("".join(docs), mongo_mms_export.decode_timeseries_block(encoded, len(docs)))
+
+    def test_truncated(self):
+        encoded = self.check_round_trip(make_samples(200))
+        data = read_file(encoded)
+        write_file(encoded, data + "\x01\x00")
+        self.assertRaises(Exception, mongo_mms_export.count_docs, encoded)
+        write_file(encoded, data[:-10])
+        self.assertRaises(Exception, mongo_mms_export.decode_timeseries, encoded, os.path.join(self.tmpdir, "e.bson"))
+
+    def test_dump(self):
+        files = make_dump(self.tmpdir)
+        mongo_mms_export.encode_timeseries_dump(self.tmpdir, 1)
+        members = mongo_mms_export.list_dump_files(self.tmpdir)
+        self.assertTrue("dump/mmsdbrrd/data.minute" + mongo_mms_export.TIMESERIES_EXT in members)
+        self.assertFalse("dump/mmsdbrrd/data.minute.bson" in members)
+        # Only the metrics DBs are encoded
+        self.assertTrue("dump/mmsdbconfig/config.customers.bson" in members)
+        mongo_mms_export.decode_timeseries_dump(self.tmpdir, 1)
+        self.assertEqual(sorted(files.keys()), mongo_mms_export.list_dump_files(self.tmpdir))
+        for (member, data) in files.items():
+            self.assertEqual(data, read_file(os.path.join(self.tmpdir, *member.split("/"))))
+
+class ShuffleTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = "".join([ struct.pack("<q", i * 1000003) for i in range(100) ])
+        shuffled = mongo_mms_export.shuffle_bytes(data, 8)
+        self.assertEqual(len(data), len(shuffled))
+        self.assertEqual(data, mongo_mms_export.unshuffle_bytes(shuffled, 8))
+
+class StoreTest(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.chunk_sizes = (mongo_mms_export.CHUNK_MIN, mongo_mms_export.CHUNK_AVG, mongo_mms_export.CHUNK_MAX)
+        # Several chunks per file, with the documents of the tests
+        (mongo_mms_export.CHUNK_MIN, mongo_mms_export.CHUNK_AVG, mongo_mms_export.CHUNK_MAX) = (512, 2048, 8192)
+
+    def tearDown(self):
+        (mongo_mms_export.CHUNK_MIN, mongo_mms_export.CHUNK_AVG, mongo_mms_export.CHUNK_MAX) = self.chunk_sizes
+        TempDirTest.tearDown(self)
+
+    def test_chunks(self):
+        path = os.path.join(self.tmpdir, "c.bson")
+        data = make_samples(1000)
+        write_file(path, data)
+        chunks = list(mongo_mms_export.iter_chunks(path))
+        self.assertEqual(data, "".join(chunks))
+        self.assertTrue(len(chunks) > 2)
+        for chunk in chunks:
+            self.assertTrue(len(chunk) <= mongo_mms_export.CHUNK_MAX + 200)
+        path = os.path.join(self.tmpdir, "c.metadata.json")
+        write_file(path, "x" * 20000)
+        self.assertEqual([ 8192, 8192, 3616 ], [ len(chunk) for chunk in mongo_mms_export.iter_chunks(path) ])
+
+    def test_chunks_follow_content(self):
+        path = os.path.join(self.tmpdir, "c.bson")
+        write_file(path, make_samples(1000))
+        before = list(mongo_mms_export.iter_chunks(path))
+        # Inserting documents at the start only changes the first chunks
+        write_file(path, make_samples(5, 5000) + make_samples(1000))
+        after = list(mongo_mms_export.iter_chunks(path))
+        self.assertTrue(len(set(before) & set(after)) >= len(before) - 2)
+
+    def test_truncated_bson(self):
+        path = os.path.join(self.tmpdir, "c.bson")
+        write_file(path, make_samples(10)[:-3])
+        self.assertRaises(Exception, list, mongo_mms_export.iter_chunks(path))
+
+    def test_store(self):
+        files = make_dump(self.tmpdir)
+        store = os.path.join(self.tmpdir, "store")
+        new_chunks = mongo_mms_export.store_dump(self.tmpdir, store, "12345", 2)
+        self.assertTrue(new_chunks)
+        for checksum in new_chunks:
+            self.assertTrue(os.path.isfile(os.path.join(store, mongo_mms_export.STORE_CHUNKS, checksum[:2], checksum)))
+        recipe = read_file(os.path.join(store, mongo_mms_export.STORE_RECIPES, "12345")).splitlines()
+        self.assertEqual(sorted(files.keys()), [ line.split("\t")[0] for line in recipe ])
+        # The same data adds no chunk
+        self.assertEqual([], mongo_mms_export.store_dump(self.tmpdir, store, "12346", 2))
+        # A new collection only adds its own chunks
+        write_file(os.path.join(self.tmpdir, "dump", "mmsdbrrd", "data.hour.bson"), make_samples(30, 9000))
+        self.assertTrue(0 < len(mongo_mms_export.store_dump(self.tmpdir, store, "12347", 2)) < len(new_chunks))
+
+class MergeShardDumpsTest(TempDirTest):
+
+    def test_merge(self):
+        shards = []
+        for (i, count) in enumerate((10, 0, 25)):
+            shard_dir = os.path.join(self.tmpdir, "shard%d" % (i))
+            data = make_samples(count, i * 100)
+            write_file(os.path.join(shard_dir, "dump", "mmsdbrrd", "data.minute.bson"), data)
+            write_file(os.path.join(shard_dir, "dump", "mmsdbrrd", "data.minute.metadata.json"), '{"shard":%d}' % (i))
+            write_file(os.path.join(shard_dir, "dump", "mmsdbrrd", "system.indexes.bson"), make_samples(2, i))
+            shards.append((shard_dir, data))
+        write_file(os.path.join(self.tmpdir, "shard2", "dump", "mmsdbping", "data.pings.bson"), make_samples(4))
+        merged = os.path.join(self.tmpdir, "merged")
+        mongo_mms_export.merge_shard_dumps([ shard_dir for (shard_dir, _) in shards ], merged)
+        db_dir = os.path.join(merged, "dump", "mmsdbrrd")
+        self.assertEqual("".join([ data for (_, data) in shards ]), read_file(os.path.join(db_dir, "data.minute.bson")))
+        self.assertEqual(35, mongo_mms_export.count_docs(os.path.join(db_dir, "data.minute.bson")))
+        self.assertEqual('{"shard":0}', read_file(os.path.join(db_dir, "data.minute.metadata.json")))
+        self.assertEqual(make_samples(2, 0), read_file(os.path.join(db_dir, "system.indexes.bson")))
+        self.assertEqual(make_samples(4), read_file(os.path.join(merged, "dump", "mmsdbping", "data.pings.bson")))
+
+if __name__ == '__main__':
+    unittest.main()
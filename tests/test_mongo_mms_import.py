@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+'''
+Tests of the pure functions of 'mongo_mms_import.py': the verification of
+the data against its manifest, the extraction of an indexed archive, the
+rebuild of the data from the deduplicating store, and the order and the
+records of the loads.
+
+'pymongo' is only needed to talk to the target instance, it is replaced
+by an empty module when it is not installed.
+
+Run with: python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import types
+import unittest
+
+try:
+    import bson.son
+    import pymongo
+except ImportError:
+    for name in ("bson", "bson.son", "pymongo", "pymongo.mongo_client"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["bson"].son = sys.modules["bson.son"]
+    sys.modules["bson.son"].SON = dict
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOTDIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mongo_mms_export
+import mongo_mms_import
+from test_mongo_mms_export import TempDirTest, make_dump, make_samples, read_file, write_file
+
+class FakeLoads(object):
+    '''
+    The IMPORTER_LOADS collection, with the only query 'is_entry_loaded' uses.
+    '''
+
+    def __init__(self, docs):
+        self.docs = dict([ (doc["_id"], doc) for doc in docs ])
+
+    def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+class ManifestTest(TempDirTest):
+
+    def test_verify(self):
+        make_dump(self.tmpdir)
+        mongo_mms_export.write_manifest(self.tmpdir, 1)
+        entries = mongo_mms_export.read_manifest(self.tmpdir)
+        for entry in entries:
+            self.assertEqual(None, mongo_mms_import.verify_manifest_entry(self.tmpdir, entry))
+        mongo_mms_import.verify_manifest(self.tmpdir, entries, 2, set())
+        path = os.path.join(self.tmpdir, "dump", "mmsdbrrd", "data.minute.bson")
+        data = read_file(path)
+        write_file(path, data[:-1] + "\x01")
+        entry = [ entry for entry in entries if entry['path'] == "dump/mmsdbrrd/data.minute.bson" ][0]
+        self.assertTrue(mongo_mms_import.verify_manifest_entry(self.tmpdir, entry).startswith("bad checksum"))
+        write_file(path, data + "\x00")
+        self.assertTrue(mongo_mms_import.verify_manifest_entry(self.tmpdir, entry).startswith("bad checksum"))
+        os.remove(path)
+        self.assertTrue(mongo_mms_import.verify_manifest_entry(self.tmpdir, entry).startswith("missing file"))
+
+    def test_verify_fails(self):
+        make_dump(self.tmpdir)
+        mongo_mms_export.write_manifest(self.tmpdir, 1)
+        entries = mongo_mms_export.read_manifest(self.tmpdir)
+        os.remove(os.path.join(self.tmpdir, "dump", "mms_version"))
+        self.assertRaises(SystemExit, mongo_mms_import.verify_manifest, self.tmpdir, entries, 1, set())
+
+    def test_case_id(self):
+        make_dump(self.tmpdir)
+        self.assertEqual("12345", mongo_mms_import.get_case_id(os.path.join(self.tmpdir, "dump")))
+
+class ArchiveTest(TempDirTest):
+
+    def make_archive(self):
+        files = make_dump(os.path.join(self.tmpdir, "in"))
+        archive = os.path.join(self.tmpdir, "data" + mongo_mms_export.ARCHIVE_EXT)
+        mongo_mms_export.write_archive(os.path.join(self.tmpdir, "in"), archive)
+        return (files, archive)
+
+    def test_explode(self):
+        (files, archive) = self.make_archive()
+        target_dir = os.path.join(self.tmpdir, "out")
+        entries = mongo_mms_import.explode_archive(archive, target_dir, [], 2, [])
+        self.assertEqual(sorted(files.keys()), [ entry['path'] for entry in entries ])
+        for (member, data) in files.items():
+            self.assertEqual(data, read_file(os.path.join(target_dir, *member.split("/"))))
+        self.assertEqual("1.3", mongo_mms_import.get_archive_mms_version(archive))
+
+    def test_explode_only(self):
+        (files, archive) = self.make_archive()
+        target_dir = os.path.join(self.tmpdir, "out")
+        entries = mongo_mms_import.explode_archive(archive, target_dir, [ "mmsdbrrd.data.minute" ], 1, [])
+        expected = [ member for member in sorted(files.keys()) if not member.startswith("dump/mmsdbconfig/") ]
+        self.assertEqual(expected, [ entry['path'] for entry in entries ])
+        self.assertEqual(expected, mongo_mms_export.list_dump_files(target_dir))
+
+    def test_member_selected(self):
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/mmsdb/data.hosts.bson", []))
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/mmsdb/data.hosts.bson", [ "mmsdb" ]))
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/mmsdb/data.hosts.metadata.json", [ "mmsdb.data.hosts" ]))
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/mmsdbrrd/data.minute" + mongo_mms_export.TIMESERIES_EXT, [ "mmsdbrrd.data.minute" ]))
+        self.assertFalse(mongo_mms_import.is_member_selected("dump/mmsdb/data.hosts.bson", [ "mmsdb.data.groups" ]))
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/mms_version", [ "mmsdb" ]))
+        self.assertTrue(mongo_mms_import.is_member_selected("dump/_collections/importer/logs", [ "mmsdb" ]))
+
+    def test_unsafe_gzip(self):
+        gzipfile = os.path.join(self.tmpdir, "data.gzip")
+        target_dir = os.path.join(self.tmpdir, "out")
+        for (name, linkname) in (("dump/../../evil", None), ("dump/evil", "../../../etc")):
+            tar = tarfile.open(gzipfile, "w:gz")
+            info = tarfile.TarInfo(name)
+            if linkname:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+            tar.addfile(info)
+            tar.close()
+            self.assertRaises(Exception, mongo_mms_import.explode_gzip, gzipfile, target_dir)
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil")))
+            self.assertFalse(os.path.lexists(os.path.join(target_dir, "dump", "evil")))
+
+class StoreTest(TempDirTest):
+
+    def test_rebuild(self):
+        files = make_dump(os.path.join(self.tmpdir, "in"))
+        store = os.path.join(self.tmpdir, "store")
+        mongo_mms_export.store_dump(os.path.join(self.tmpdir, "in"), store, "12345", 2)
+        target_dir = os.path.join(self.tmpdir, "out")
+        mongo_mms_import.rebuild_dump(store, "12345", target_dir, [], 2, [])
+        self.assertEqual(sorted(files.keys()), mongo_mms_export.list_dump_files(target_dir))
+        for (member, data) in files.items():
+            self.assertEqual(data, read_file(os.path.join(target_dir, *member.split("/"))))
+
+    def test_packs(self):
+        source = os.path.join(self.tmpdir, "in")
+        files = make_dump(source)
+        store = os.path.join(self.tmpdir, "store")
+        received = os.path.join(self.tmpdir, "received")
+        packs = os.path.join(self.tmpdir, "packs")
+        os.makedirs(packs)
+        new_chunks = mongo_mms_export.store_dump(source, store, "12345", 1)
+        first = mongo_mms_export.package_delta(packs, store, "12345", new_chunks)
+        self.assertEqual("12345", mongo_mms_import.receive_pack(first, received))
+        # The second pack only has the chunks of the new collection
+        files["dump/mmsdbrrd/data.hour.bson"] = make_samples(30, 9000)
+        write_file(os.path.join(source, "dump", "mmsdbrrd", "data.hour.bson"), files["dump/mmsdbrrd/data.hour.bson"])
+        new_chunks = mongo_mms_export.store_dump(source, store, "12346", 1)
+        second = mongo_mms_export.package_delta(packs, store, "12346", new_chunks)
+        self.assertTrue(os.path.getsize(second) < os.path.getsize(first))
+        self.assertEqual("12346", mongo_mms_import.receive_pack(second, received))
+        target_dir = os.path.join(self.tmpdir, "out")
+        mongo_mms_import.rebuild_dump(received, "12346", target_dir, [], 1, [])
+        for (member, data) in files.items():
+            self.assertEqual(data, read_file(os.path.join(target_dir, *member.split("/"))))
+
+    def test_missing_chunks(self):
+        make_dump(os.path.join(self.tmpdir, "in"))
+        store = os.path.join(self.tmpdir, "store")
+        mongo_mms_export.store_dump(os.path.join(self.tmpdir, "in"), store, "12345", 1)
+        shutil.rmtree(os.path.join(store, mongo_mms_export.STORE_CHUNKS))
+        self.assertRaises(SystemExit, mongo_mms_import.rebuild_dump, store, "12345", os.path.join(self.tmpdir, "out"), [], 1, [])
+
+    def test_unsafe_recipe(self):
+        make_dump(os.path.join(self.tmpdir, "in"))
+        store = os.path.join(self.tmpdir, "store")
+        mongo_mms_export.store_dump(os.path.join(self.tmpdir, "in"), store, "12345", 1)
+        recipe_path = os.path.join(store, mongo_mms_export.STORE_RECIPES, "12345")
+        (member, chunks) = read_file(recipe_path).splitlines()[0].split("\t")
+        write_file(recipe_path, "dump/../../evil\t%s\n" % (chunks))
+        self.assertRaises(Exception, mongo_mms_import.rebuild_dump, store, "12345", os.path.join(self.tmpdir, "out"), [], 1, [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil")))
+
+class LoadsTest(unittest.TestCase):
+
+    def test_loaded(self):
+        entry = {'path':"dump/mmsdbrrd/data.minute.bson", 'size':10, 'docs':3, 'sha1':"abc"}
+        load_id = mongo_mms_import.get_load_id(entry, "12345")
+        self.assertEqual("12345:mmsdbrrd.data.minute:abc", load_id)
+        self.assertFalse(mongo_mms_import.is_entry_loaded(FakeLoads([]), entry, "12345"))
+        self.assertFalse(mongo_mms_import.is_entry_loaded(FakeLoads([ {"_id":load_id, "complete":False} ]), entry, "12345"))
+        self.assertTrue(mongo_mms_import.is_entry_loaded(FakeLoads([ {"_id":load_id, "complete":True} ]), entry, "12345"))
+        # The same data for another case, or changed data, is not loaded
+        self.assertFalse(mongo_mms_import.is_entry_loaded(FakeLoads([ {"_id":load_id, "complete":True} ]), entry, "12346"))
+        entry['sha1'] = "abd"
+        self.assertFalse(mongo_mms_import.is_entry_loaded(FakeLoads([ {"_id":load_id, "complete":True} ]), entry, "12345"))
+
+class PriorityTest(TempDirTest):
+
+    def test_priority(self):
+        entries = [ {'path':path} for path in ("dump/mmsdbrrd/data.minute.bson", "dump/mmsdbrrd/data.hour.bson", "dump/mmsdbpings/data.latest.bson",
+                                               "dump/mmsdb/data.hosts.bson", "dump/_collections/importer/logs") ]
+        recent_metrics = mongo_mms_import.get_recent_metrics("1.3", entries)
+        self.assertEqual(mongo_mms_import.RECENT_METRICS[None], recent_metrics)
+        self.assertEqual([ mongo_mms_import.PRIORITY_RECENT, mongo_mms_import.PRIORITY_HISTORY, mongo_mms_import.PRIORITY_RECENT,
+                           mongo_mms_import.PRIORITY_CONFIG, mongo_mms_import.PRIORITY_EXPORTED ],
+                         [ mongo_mms_import.get_restore_priority(entry, recent_metrics) for entry in entries ])
+
+    def test_unmatched_pattern(self):
+        errors = mongo_mms_export.Errors
+        out = os.path.join(self.tmpdir, "out")
+        sys.stdout.close()
+        sys.stdout = open(out, 'w')
+        mongo_mms_import.get_recent_metrics("1.3", [ {'path':"dump/mmsdbrrd/data.minute.bson"}, {'path':"dump/mmsdb/data.latest.bson"} ])
+        sys.stdout.flush()
+        warnings = [ line for line in read_file(out).splitlines() if line.startswith("WARNING") ]
+        self.assertEqual(len(mongo_mms_import.RECENT_METRICS[None]) - 1, len(warnings))
+        self.assertEqual(errors, mongo_mms_export.Errors)
+
+if __name__ == '__main__':
+    unittest.main()